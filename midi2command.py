@@ -6,17 +6,33 @@
 Kill all Processing processes when the kill MIDI message is received, and restart them.
 """
 
+import time
+
+# Start of the startup timeline, before anything else is imported
+MODULE_LOADED_AT = time.perf_counter()
+
+import argparse
+import array
+import bisect
+import gc
+import heapq
+import json
 import logging
+import math
 import shlex
+import signal
+import socket
+import socketserver
+import struct
 import subprocess
 import sys
-import time
+import threading
 import os
+import weakref
 
-import psutil
+# psutil (Strobot restarts), yaml (YAML mapping files), asyncio (--asyncio) and multiprocessing
+# (--sharded) are imported when first needed, to get the first routes up sooner at boot
 import rtmidi
-from rtmidi.midiutil import open_midiport
-from rtmidi.midiconstants import *
 
 MIDI_BUS_CONFIGURATION_EMERGENCY_CONTROL   = "Bus 1"
 MIDI_BUS_CONFIGURATION_GUITAR_WING         = "Livid Guitar Wing"
@@ -29,12 +45,19 @@ MIDI_REINIT_CHANNEL            = 7
 MIDI_REINIT_PITCH              = 46
 STROBOT_REINIT_CHANNEL         = 7
 STROBOT_REINIT_PITCH           = 47
+MIDI_RESYNC_CHANNEL            = 7
+MIDI_RESYNC_PITCH              = 48
 STROBOT_PATH                   = "/Applications/Strobot/Strobot.app/Contents/MacOS/Strobot"
+STROBOT_PROCESS_NAME           = "Strobot"
+STROBOT_EXIT_TIMEOUT           = 5.0      #Seconds to wait for Strobot to exit once killed
+STROBOT_RESTART_DEBOUNCE       = 2.0      #Restart requests closer than this to the previous one are ignored
 
 STATUS_CC                      = 0xB0
 STATUS_NOTE_ON                 = 0x90
 STATUS_NOTE_OFF                = 0x80
 STATUS_PC                      = 0xC0
+ROUTED_STATUSES                = (STATUS_NOTE_OFF, STATUS_NOTE_ON, STATUS_CC)     # Statuses covered by the routing tables, in table order
+ROUTE_COUNT                    = len(ROUTED_STATUSES) * 16 * 128
 
 OUTPUT_CHANNEL_KEMPER_AMP      = 3        #For reference, the VoiceLive is configured to listen on Channel 2
 OUTPUT_CHANNEL_ABLETON_VOICEFX = 5
@@ -42,519 +65,3495 @@ OUTPUT_CHANNEL_ABLETON_VOICEFX = 5
 ABLETON_VOICE_FX_CTRL_CHANNEL  = 0
 ABLETON_GTR_CTRL_CHANNEL       = 1
 
-REINIT_CALL                    = False
+#Pitches and controllers for messages coming from the Guitar Wing
+PITCH_WING_BIG_ROUND_BUTTON_1  = 36
+PITCH_WING_BIG_ROUND_BUTTON_2  = 37
+PITCH_WING_BIG_ROUND_BUTTON_3  = 38
+PITCH_WING_BIG_ROUND_BUTTON_4  = 39
+PITCH_WING_ARROW_NEXT          = 40
+PITCH_WING_ARROW_PREVIOUS      = 41
+PITCH_WING_SMALL_RECTANGLE_1   = 42
+PITCH_WING_SMALL_RECTANGLE_2   = 43
+PITCH_WING_SMALL_RECTANGLE_3   = 44
+PITCH_WING_SMALL_RECTANGLE_4   = 45
+PITCH_WING_SMALL_SWITCH_1      = 46
+PITCH_WING_SMALL_SWITCH_2      = 47
+PITCH_WING_SMALL_SWITCH_3      = 48
+PITCH_WING_SMALL_SWITCH_4      = 49
+PITCH_TOGGLE                   = 4
+CC_SMALL_FADER_1               = 1
+CC_SMALL_FADER_2               = 2
+CC_BIG_FADER                   = 3
+
+MAPPING_PATH                   = os.path.join(os.path.dirname(os.path.abspath(__file__)), "midi2command.json")
+MAPPING_WATCH_INTERVAL         = 1.0      #Seconds between two checks of the mapping file modification time
+
+OUTPUT_QUEUE_SIZE              = 1024     #Messages buffered per output port, newer messages are dropped when full
+OUTPUT_CC_COALESCE_WINDOW      = 0.010    #Seconds during which a queued CC can still be replaced by a newer value
+OUTPUT_CC_MAX_RATE             = 100      #Default messages per second sent to Ableton for a rate-limited controller
+OUTPUT_RESYNC_TIMEOUT          = 2.0      #Seconds a resync waits for room in the queue of an output port before giving up
+
+PORT_WATCH_INTERVAL            = 0.5      #Seconds between two checks of the MIDI port list while a port is missing
+PORT_WATCH_MAX_INTERVAL        = 4.0      #Longest interval between two checks once every port is connected
+PORT_RETRY_MAX_INTERVAL        = 8.0      #Longest backoff before retrying to open a port which failed to open
+
+SHARD_INPUTS                   = ("emergency_control", "ableton_in_voice_fx", "guitar_wing", "ableton_in_gtr")   #One worker process per input port in sharded mode
+SHARD_HEARTBEAT_INTERVAL       = 0.5      #Seconds between two heartbeats/stats updates of a shard worker
+SHARD_HEARTBEAT_TIMEOUT        = 5.0      #A shard worker without heartbeat for that long is killed and restarted
+SHARD_CALLBACK_TIMEOUT         = 2.0      #A shard worker whose callback has been running for that long is killed and restarted
+SHARD_RESTART_BACKOFF          = 2.0      #Minimum seconds between the start of a shard worker and its restart
+
+MACRO_SPIN_WINDOW              = 0.0005   #Seconds before a macro step is due during which the timer thread spins instead of sleeping
+
+COMMAND_WORKERS                = 4        #Threads running the commands of the rules, i.e. at most that many processes at once
+COMMAND_QUEUE_SIZE             = 64       #Commands waiting for a worker, newer triggers are dropped when full
+COMMAND_TIMEOUT                = 30.0     #Default seconds after which a command is killed, with its child processes
+COMMAND_DEBOUNCE               = 0.5      #Default seconds during which a command ignores new triggers
+COMMAND_KILL_TIMEOUT           = 2.0      #Seconds waited for the output of a killed command, before closing its pipe
+COMMAND_OUTPUT_MAX             = 4096     #Bytes kept of the end of the output of a command
+
+MIDI_TICK                      = 60.0 / 120 / 24   #Seconds of one MIDI clock tick at 120 BPM, the latency budget of the realtime mode
+REALTIME_PRIORITY              = 50       #SCHED_FIFO priority of the MIDI threads in realtime mode, where the OS permits it
+REALTIME_NICE                  = -10      #Niceness of the process in realtime mode, where permitted
+REALTIME_SWITCH_INTERVAL       = 0.0005   #GIL switch interval in realtime mode, a busy thread hands the GIL over sooner
+REALTIME_GC_IDLE               = 2.0      #Seconds without any MIDI event after which a controlled garbage collection runs
+REALTIME_GC_MAX_PENDING        = 100000   #Objects pending in the youngest GC generation forcing a collection, even while playing
+REALTIME_WATCH_INTERVAL        = 0.1      #Seconds between two wake-ups of the realtime watchdog, which measures how late they are
+
+NETWORK_SCHEME                 = "udp://"  #Port names starting with it are network ports, as udp://host:port
+NETWORK_MAGIC                  = b"M2CN"
+NETWORK_HEADER                 = struct.Struct("!4sIIdH")  #magic, sender session, sequence number, sender time of the first message, message count
+NETWORK_MESSAGE                = struct.Struct("!fH")      #seconds after the first message, length, followed by the message bytes
+NETWORK_MAX_DATAGRAM           = 1200     #Bytes per datagram, under the MTU of any LAN - a longer SysEx is sent alone, fragmented by IP
+NETWORK_MAX_MESSAGE            = 65507 - NETWORK_HEADER.size - NETWORK_MESSAGE.size   #Longest message fitting in a UDP datagram
+NETWORK_REORDER_WINDOW         = 64       #Sequence numbers behind the newest one for which a datagram is still taken as reordered
+NETWORK_SESSION_TIMEOUT        = 60.0     #Seconds after which a silent sender session is forgotten
+NETWORK_JITTER_BUFFER          = 0.005    #Seconds a received message is held past the shortest transit time, to absorb the network jitter
+NETWORK_CLOCK_WINDOW           = 10.0     #Seconds of datagrams over which the shortest transit time is taken, following the clock drift
+NETWORK_POLL_INTERVAL          = 0.5      #Longest wait of the receiving thread, which checks whether the port was closed
+
+STATS_SOCKET_PATH              = "/tmp/midi2command.sock"
+CONTROL_SOCKET_PATH            = "/tmp/midi2command-control.sock"
+INJECTED_DELTATIME             = -1.0     #Deltatime of the input messages injected through the control socket, left out of the deltatime and jitter metrics
+JOURNAL_PATH                   = "/tmp/midi2command.journal"
+JOURNAL_BUFFER_RECORDS         = 4096     #Records per journal buffer, two buffers are preallocated
+JOURNAL_FLUSH_INTERVAL         = 1.0      #Seconds between two writes of a partially filled journal buffer
+JOURNAL_MAX_BYTES              = 16 * 1024 * 1024   #Size at which the journal file is rotated
+JOURNAL_BACKUPS                = 4        #Rotated journal files kept, as path.1 (newest) to path.4
+JOURNAL_MAGIC                  = b"M2CJ"
+JOURNAL_RECORD                 = struct.Struct("<dfBBBBBB2x")   #timestamp, deltatime, direction, source, length, status, data1, data2
+JOURNAL_IN                     = 0
+JOURNAL_OUT                    = 1
+JOURNAL_SOURCES                = ("emergency_strobot", "emergency_midi", "guitar_wing", "voice_fx", "gtr",
+                                  "ableton_out", "audio_interface_out")   #Record source ids: handlers, then output ports, then the other output ports as they open
+HISTOGRAM_BOUNDS               = (5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 1e-1)  #Upper bounds of the histogram buckets, in seconds
 
 log = logging.getLogger('midi2command')
 
 
+def build_route_offsets():
+    """Status byte -> offset of its (status, channel) row in the routing tables, -1 if the status is not routed"""
+    offsets = [-1] * 256
+    for index, status in enumerate(ROUTED_STATUSES):
+        for channel in range(16):
+            offsets[status + channel] = (index * 16 + channel) * 128
+    return offsets
+
+ROUTE_OFFSETS = build_route_offsets()
+
+# Shared decode stage: status byte -> (status, channel), channel being None for system messages.
+# The tuples are built once, so decoding an event in a callback does not create any object
+STATUS_DECODE = [(byte & 0xF0, byte & 0x0F) if byte < 0xF0 else (byte, None) for byte in range(256)]
+
+# Every outgoing message built from the mapping, as immutable bytes shared between identical messages
+MESSAGE_CACHE = {}
+
+def cached_message(message):
+    """
+    Return the shared bytes object for an outgoing message. Being immutable, the same object can be
+    sent from any table and any thread, and bytes are not tracked by the garbage collector
+    """
+    message = bytes(message)
+    return MESSAGE_CACHE.setdefault(message, message)
+
+
+# Port names, which the "ports" section of a mapping file can override
+DEFAULT_PORTS = {
+    "emergency_control"   : MIDI_BUS_CONFIGURATION_EMERGENCY_CONTROL,
+    "guitar_wing"         : MIDI_BUS_CONFIGURATION_GUITAR_WING,
+    "ableton_in_voice_fx" : MIDI_BUS_CONFIGURATION_ABLETON_IN_VOICE_FX,
+    "ableton_out"         : MIDI_BUS_CONFIGURATION_ABLETON_OUT,
+    "ableton_in_gtr"      : MIDI_BUS_CONFIGURATION_ABLETON_IN_GTR,
+    "audio_interface_out" : MIDI_BUS_CONFIGURATION_AUDIO_INTERFACE_OUT,
+}
+
+STATUS_NAMES = {
+    "note_off" : STATUS_NOTE_OFF,
+    "note_on"  : STATUS_NOTE_ON,
+    "cc"       : STATUS_CC,
+    "pc"       : STATUS_PC,
+}
+
+# Built-in routing rules, in the same format as the "routes" section of a mapping file.
+# Channels are numbered from 1, "data" matches data1 (and data2 if two values are given), and
+# each "output" message is a list of bytes, where a byte can also be taken from the incoming event:
+# "data1", "data2", or {"from": "data1", "offset": -1, "scale": [127, 100], "min": 0, "max": 127}
+# Rules are matched in order, the first one covering an event wins. A "curve" ("linear", "log",
+# "exp" or a list of 128 values) can be applied to a byte taken from the event before scaling it.
+# A "sequence" sends more messages later, as a list of {"delay": seconds after the event, "output": [...]}
+# steps. A new event on a rule cancels the steps still pending for the previous one, or for any
+# rule sharing the same "group" name.
+# A "command" runs a program, given as a list of arguments or as a string split like a shell would
+# ("shell": true runs the string in a shell), where "{data1}" and "{data2}" are replaced by the event values.
+# Optional: "timeout" (seconds, COMMAND_TIMEOUT), "debounce" (seconds during which new triggers are
+# ignored, COMMAND_DEBOUNCE) and "concurrency" (processes of the rule at once, 1). Commands (and the
+# fan-out) still run while the output port of their table is closed.
+# The "outputs" section limits the rate of continuous controllers per output port: a newer value
+# received before 1/max_rate seconds is held, and the last one held is sent once the delay is over.
+# The "fanout" section mirrors the messages of a route set to more output ports, e.g.
+# "fanout": {"guitar_wing": [{"output": "lighting_out", "channel": 10, "transform": {"curve": "log"},
+#                             "filter": {"status": ["cc"], "channel": [1], "data1": [56]}}]}
+# where the output key needs a name in "ports". Every key but "output" is optional: the channel is
+# remapped, the last data byte goes through the transform, and the filter selects the messages.
+# An output can also follow a "setlist": {"channel": 4, "presets": [programs in show order],
+# "preload": [messages sent as soon as the previous preset is active, "data1" being the next program]}
+# A port name can also be "udp://host:port", to bridge two instances over the network: an output
+# port sends its messages to that address (e.g. as a fan-out destination), and on the other host an
+# input port listening on it, e.g. "guitar_wing": "udp://0.0.0.0:5004", routes them through its table.
+DEFAULT_MAPPING = {
+    "outputs": {
+        "ableton_out": {
+            "rate_limits": [
+                {"channel": 1, "controller": 56, "max_rate": OUTPUT_CC_MAX_RATE},     # Big fader
+            ],
+        },
+    },
+    "routes": {
+        "guitar_wing": [
+            {"name": "Big round button 1 on",  "status": "note_on",  "data": PITCH_WING_BIG_ROUND_BUTTON_1, "output": [[STATUS_CC + 4, 13, 127]]},
+            {"name": "Big round button 2 on",  "status": "note_on",  "data": PITCH_WING_BIG_ROUND_BUTTON_2, "output": [[STATUS_CC, 16, 127], [STATUS_NOTE_ON, 44, 127]]},
+            {"name": "Big round button 3 on",  "status": "note_on",  "data": PITCH_WING_BIG_ROUND_BUTTON_3, "output": [[STATUS_CC, 16, 110], [STATUS_NOTE_ON, 44, 127]]},
+            {"name": "Big round button 4 on",  "status": "note_on",  "data": PITCH_WING_BIG_ROUND_BUTTON_4, "output": [[STATUS_CC, 52, 76]]},
+            {"name": "Small rectangle 1 on",   "status": "note_on",  "data": PITCH_WING_SMALL_RECTANGLE_1,  "output": [[STATUS_CC, 16, 0]]},
+            {"name": "Small rectangle 2 on",   "status": "note_on",  "data": PITCH_WING_SMALL_RECTANGLE_2,  "output": [[STATUS_CC, 16, 45]]},
+            {"name": "Small rectangle 3 on",   "status": "note_on",  "data": PITCH_WING_SMALL_RECTANGLE_3,  "output": [[STATUS_CC, 16, 64]]},
+            {"name": "Small rectangle 4 on",   "status": "note_on",  "data": PITCH_WING_SMALL_RECTANGLE_4,  "output": [[STATUS_CC, 16, 110]]},
+            {"name": "Big round button 1 off", "status": "note_off", "data": PITCH_WING_BIG_ROUND_BUTTON_1, "output": [[STATUS_CC + 4, 13, 0]]},
+            {"name": "Big round button 2 off", "status": "note_off", "data": PITCH_WING_BIG_ROUND_BUTTON_2, "output": [[STATUS_NOTE_ON, 44, 127]]},
+            {"name": "Big round button 3 off", "status": "note_off", "data": PITCH_WING_BIG_ROUND_BUTTON_3, "output": [[STATUS_NOTE_ON, 44, 127]]},
+            {"name": "Big round button 4 off", "status": "note_off", "data": PITCH_WING_BIG_ROUND_BUTTON_4, "output": [[STATUS_CC, 52, 0]]},
+            {"name": "Big fader",              "status": "cc",       "data": CC_BIG_FADER,                  "output": [[STATUS_CC, 56, {"from": "data2", "scale": [127, 100]}]]},
+        ],
+        "voice_fx": [
+            {"name": "Disable the RMX Spiral", "status": "note_on",  "channel": ABLETON_VOICE_FX_CTRL_CHANNEL + 1, "data": 35,
+             "output": [[STATUS_CC, 20, 0]]},
+            {"name": "VoiceFX on",             "status": "note_on",  "channel": ABLETON_VOICE_FX_CTRL_CHANNEL + 1,
+             "output": [[STATUS_CC + OUTPUT_CHANNEL_ABLETON_VOICEFX, "data1", "data2"]]},
+            {"name": "VoiceFX off",            "status": "note_off", "channel": ABLETON_VOICE_FX_CTRL_CHANNEL + 1,
+             "output": [[STATUS_CC + OUTPUT_CHANNEL_ABLETON_VOICEFX, "data1", 0]]},
+        ],
+        "gtr": [
+            {"name": "Kemper amp preset",      "status": "note_on",  "channel": ABLETON_GTR_CTRL_CHANNEL + 1,
+             "output": [[STATUS_PC + OUTPUT_CHANNEL_KEMPER_AMP, {"from": "data1", "offset": -1, "min": 0}]]},
+        ],
+    },
+}
+
+
+class RouteAction(object):
+    """
+    Interface of the entries of a routing table which are not plain messages: the output sender
+    calls dispatch(sender) instead of sending them. Subclasses must override dispatch(). It is a
+    plain class rather than an abc.ABC, as the senders check isinstance() on every message and an
+    ABC makes that check several times slower
+    """
+    def dispatch(self, sender):
+        """
+        Act on an event routed to sender (a MidiOutputSender, or a MissingOutput while the port is
+        closed). Called on the input callback thread, so it must not block
+        """
+        raise NotImplementedError("%s does not implement RouteAction.dispatch" % type(self).__name__)
+
+
+class MacroSequence(RouteAction):
+    """Timed steps of a rule, as (seconds after the trigger, messages) pairs, sent by the MacroScheduler"""
+    def __init__(self, group, steps):
+        self.group = group
+        self.steps = steps
+
+    def dispatch(self, sender):
+        macros.trigger(self, sender)
+
+
+class FanOut(RouteAction):
+    """Messages of an event for another output port, sent through the sender of that port if it is open"""
+    def __init__(self, key, messages, senders):
+        self.key = key
+        self.messages = messages
+        self.senders = senders
+
+    def dispatch(self, sender):
+        target = self.senders.get(self.key)
+        if target is not None:
+            for message in self.messages:
+                target.send_message(message)
+
+
+class CommandAction(RouteAction):
+    """Command of a rule with its arguments for an event, queued on the CommandRunner"""
+    def __init__(self, rule, args):
+        self.rule = rule
+        self.key = rule.commandKey
+        self.args = args
+
+    def dispatch(self, sender):
+        runner.submit(self)
+
+
 class Command(object):
     def __init__(self, name='', description='', status=0xB0, channel=None,
-            data=None, command=None):
+            data=None, command=None, output=None, sequence=None, group=None,
+            shell=False, timeout=COMMAND_TIMEOUT, debounce=COMMAND_DEBOUNCE, concurrency=1):
         self.name = name
         self.description = description
-        self.status = status
+        self.status = STATUS_NAMES.get(status, status)
         self.channel = channel
         self.command = command
+        self.shell = bool(shell)
+        self.timeout = float(timeout)
+        self.debounce = float(debounce)
+        self.concurrency = int(concurrency)
+        if command is not None:
+            if not command or not isinstance(command, (str, list)):
+                raise ValueError("The command of rule %r is not a string or a list of arguments" % (name,))
+            if self.shell and not isinstance(command, str):
+                raise ValueError("The shell command of rule %r must be a string, not a list of arguments" % (name,))
+            if self.timeout <= 0 or self.concurrency < 1:
+                raise ValueError("The command of rule %r needs a positive timeout and concurrency" % (name,))
+        self.commandKey = name or (command if isinstance(command, str) else " ".join(map(str, command or [])))
+        self.output = output or []
+        # Rules sharing a group cancel each other's pending steps, even those without a sequence
+        self.group = group or name
+        self.cancels = bool(sequence or group)
+        self.sequence = [(float(step["delay"]), Command(output=step["output"])) for step in sequence or []]
+        if any(delay < 0 for delay, step in self.sequence):
+            raise ValueError("Negative delay in the sequence of rule " + repr(name))
+        self._tables = None
 
         if data is None or isinstance(data, int):
             self.data = data
         elif hasattr(data, 'split'):
-            self.data = map(int, data.split())
+            self.data = list(map(int, data.split()))
+        elif isinstance(data, (list, tuple)):
+            self.data = list(map(int, data))
         else:
             raise TypeError("Could not parse 'data' field.")
+        if self.channel is not None and not 1 <= self.channel <= 16:
+            raise ValueError("Channel %r of rule %r is not in 1-16" % (self.channel, name))
+        values = [self.data] if isinstance(self.data, int) else (self.data or [])
+        if len(values) > 2 or not all(0 <= value <= 127 for value in values):
+            raise ValueError("Data %r of rule %r is not one or two values in 0-127" % (data, name))
+
+    def matched_values(self):
+        """Return the channels, data1 and data2 values covered by this command"""
+        channels = range(16) if self.channel is None else [self.channel - 1]
+        data = [self.data] if isinstance(self.data, int) else (self.data or [])
+        data1_values = range(128) if len(data) < 1 else [data[0]]
+        data2_values = range(128) if len(data) < 2 else [data[1]]
+        return channels, data1_values, data2_values
+
+    def byte_tables(self):
+        """output_table() of every output byte, computed once"""
+        if self._tables is None:
+            self._tables = [[output_table(byte) for byte in message] for message in self.output]
+        return self._tables
+
+    def used_data(self):
+        """Indexes (1, 2) of the incoming data bytes the output messages (sequence steps, command) depend on"""
+        used = set(table[0] for tables in self.byte_tables() for table in tables if table is not None)
+        for delay, step in self.sequence:
+            used |= step.used_data()
+        if self.command is not None:
+            text = self.command if isinstance(self.command, str) else " ".join(map(str, self.command))
+            used |= set(index for index in (1, 2) if "{data%d}" % index in text)
+        return used
+
+    def command_args(self, data1, data2):
+        """Arguments of the command for an event, or the command line when run in a shell"""
+        def substitute(text):
+            text = str(text)
+            for index, value in ((1, data1), (2, data2)):
+                if value is not None:
+                    text = text.replace("{data%d}" % index, str(value))
+            return text
+        if not isinstance(self.command, str):
+            return [substitute(arg) for arg in self.command]
+        return substitute(self.command) if self.shell else shlex.split(substitute(self.command))
+
+    def build_messages(self, data1, data2):
+        """Messages to send for an event, followed by its CommandAction and its MacroSequence if the rule has timed steps or a group"""
+        event = (None, data1, data2)
+        messages = tuple(cached_message([byte if table is None else table[1][event[table[0]]]
+                                         for byte, table in zip(message, tables)])
+                         for message, tables in zip(self.output, self.byte_tables()))
+        if self.command is not None:
+            messages += (CommandAction(self, self.command_args(data1, data2)),)
+        if self.cancels:
+            steps = tuple((delay, step.build_messages(data1, data2)) for delay, step in self.sequence)
+            messages += (MacroSequence(self.group, steps),)
+        return messages
+
+
+# Scaling curves for continuous controllers, precomputed for the 128 possible input values
+CURVES = {
+    "linear" : tuple(range(128)),
+    "log"    : tuple(int(round(127.0 * math.log1p(value) / math.log1p(127))) for value in range(128)),
+    "exp"    : tuple(int(round(math.expm1(value * math.log(128) / 127.0))) for value in range(128)),
+}
+
+def curve_table(curve):
+    """Return the 128 values lookup table of a named curve, or of a custom list of 128 values"""
+    if isinstance(curve, (list, tuple)):
+        if len(curve) != 128:
+            raise ValueError("A custom curve needs 128 values, not %d" % len(curve))
+        return tuple(int(value) for value in curve)
+    if curve not in CURVES:
+        raise ValueError("Unknown curve: %r" % (curve,))
+    return CURVES[curve]
+
+
+def output_byte(spec, data1, data2):
+    """
+    Evaluate one byte of an output message for the given incoming data bytes. The value taken
+    from the event goes through the curve, then is scaled, offset and clamped
+    """
+    if isinstance(spec, int):
+        return spec
+    if not isinstance(spec, dict):
+        spec = {"from": spec}
+    if spec.get("from") == "data1":
+        value = data1
+    elif spec.get("from") == "data2":
+        value = data2
+    else:
+        raise ValueError("Unknown output byte source: %r" % (spec.get("from"),))
+    if "curve" in spec:
+        value = curve_table(spec["curve"])[value]
+    if "scale" in spec:
+        numerator, denominator = spec["scale"]
+        value = int(value * float(numerator) / denominator)
+    value += spec.get("offset", 0)
+    if "min" in spec:
+        value = max(value, spec["min"])
+    if "max" in spec:
+        value = min(value, spec["max"])
+    return value
+
+
+def output_table(spec):
+    """
+    Precompute an output byte: None for a constant byte, else (index of the incoming data byte it
+    is taken from, output value for each of the 128 possible values of that byte)
+    """
+    if isinstance(spec, int):
+        return None
+    source = spec.get("from") if isinstance(spec, dict) else spec
+    if source not in ("data1", "data2"):
+        raise ValueError("Unknown output byte source: %r" % (source,))
+    if isinstance(spec, dict) and "scale" in spec:
+        if not isinstance(spec["scale"], (list, tuple)) or len(spec["scale"]) != 2 or not spec["scale"][1]:
+            raise ValueError("A scale is [numerator, denominator] with a denominator other than 0, not %r" % (spec["scale"],))
+    return (1 if source == "data1" else 2), tuple(output_byte(spec, value, value) for value in range(128))
+
+
+class Histogram(object):
+    """
+    Fixed-bucket histogram of durations in seconds. The buckets are preallocated in an array,
+    so that recording a value does not allocate any container
+    """
+    def __init__(self, bounds=HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self.counts = array.array('L', [0]) * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {
+            "count"   : self.count,
+            "mean_us" : self.total / self.count * 1e6 if self.count else None,
+            "max_us"  : self.max * 1e6,
+            "buckets" : bucket_counts(self.bounds, self.counts),
+        }
+
+
+def bucket_counts(bounds, counts, start=0):
+    """Label the non-empty buckets of a histogram with their upper bound in microseconds"""
+    labels = ["<=%gus" % (bound * 1e6) for bound in bounds] + [">%gus" % (bounds[-1] * 1e6)]
+    return dict((label, counts[start + i]) for i, label in enumerate(labels) if counts[start + i])
+
+
+class HandlerMetrics(object):
+    """
+    Event counts and timings of one input handler: callback duration, time spent sending, and
+    inter-arrival time (deltatime from rtmidi) with the dispatch jitter it implies, i.e. how much
+    later or earlier than the driver timestamps the callbacks actually ran. Injected messages
+    (INJECTED_DELTATIME) have no driver timestamp, they only count in the callback timings.
+    Counts and callback duration histograms are also kept per route, in flat preallocated arrays.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.callback = Histogram()
+        self.send = Histogram()
+        self.deltatime = Histogram()
+        self.jitter = Histogram()
+        self._buckets = len(HISTOGRAM_BOUNDS) + 1
+        self.routeCounts = array.array('L', [0]) * ROUTE_COUNT
+        self.routeHistograms = array.array('L', [0]) * (ROUTE_COUNT * self._buckets)
+        self._lastCallback = None
+
+    def record(self, event, deltatime, start, sendStart):
+        end = time.perf_counter()
+        duration = end - start
+        self.callback.record(duration)
+        self.send.record(end - sendStart)
+        if deltatime != INJECTED_DELTATIME:
+            if self._lastCallback is not None:
+                self.deltatime.record(deltatime)
+                self.jitter.record(abs(start - self._lastCallback - deltatime))
+            self._lastCallback = start
+
+        offset = ROUTE_OFFSETS[event[0]]
+        if offset >= 0 and len(event) >= 2:
+            route = offset + event[1]
+            self.routeCounts[route] += 1
+            self.routeHistograms[route * self._buckets + bisect.bisect_left(HISTOGRAM_BOUNDS, duration)] += 1
+
+    def snapshot(self):
+        routes = []
+        for route, count in enumerate(self.routeCounts):
+            if count:
+                row, data1 = divmod(route, 128)
+                statusIndex, channel = divmod(row, 16)
+                routes.append({
+                    "status"   : ROUTED_STATUSES[statusIndex],
+                    "channel"  : channel + 1,
+                    "data1"    : data1,
+                    "count"    : count,
+                    "callback" : bucket_counts(HISTOGRAM_BOUNDS, self.routeHistograms, route * self._buckets),
+                })
+        return {
+            "count"     : self.callback.count,
+            "callback"  : self.callback.snapshot(),
+            "send"      : self.send.snapshot(),
+            "deltatime" : self.deltatime.snapshot(),
+            "jitter"    : self.jitter.snapshot(),
+            "routes"    : routes,
+        }
+
+
+class MetricsRegistry(object):
+    """
+    Metrics of every handler and output port, kept across handler recreations, plus the stats
+    of other components (reinit scheduler, Strobot supervisor...) registered as providers
+    """
+    def __init__(self):
+        self.startedAt = time.time()
+        self.handlers = {}
+        self.outputs = {}
+        self.providers = {}
+
+    def handler(self, name):
+        if name not in self.handlers:
+            self.handlers[name] = HandlerMetrics(name)
+        return self.handlers[name]
+
+    def register_output(self, sender):
+        self.outputs[sender.name] = sender
+
+    def register_provider(self, name, provider):
+        self.providers[name] = provider
+
+    def last_event(self):
+        """perf_counter time of the last event received by any handler, None if there was none yet"""
+        times = [handler._lastCallback for handler in list(self.handlers.values()) if handler._lastCallback is not None]
+        return max(times) if times else None
+
+    def snapshot(self):
+        snapshot = {
+            "uptime_s" : time.time() - self.startedAt,
+            "handlers" : dict((name, handler.snapshot()) for name, handler in list(self.handlers.items())),
+            "outputs"  : dict((name, sender.stats()) for name, sender in list(self.outputs.items())),
+        }
+        for name, provider in list(self.providers.items()):
+            snapshot[name] = provider()
+        return snapshot
+
+metrics = MetricsRegistry()
+
+
+class StartupTimeline(object):
+    """Milestones of the startup, in milliseconds since the module started loading, logged and kept for the stats"""
+    def __init__(self, startedAt=MODULE_LOADED_AT):
+        self.startedAt = startedAt
+        self.milestones = []
+
+    def mark(self, label):
+        elapsed = (time.perf_counter() - self.startedAt) * 1000.0
+        self.milestones.append((label, elapsed))
+        log.info("Startup +%.1f ms: %s", elapsed, label)
+
+    def stats(self):
+        return [[label, elapsed] for label, elapsed in self.milestones]
+
+startup = StartupTimeline()
+
+
+class RealtimeThread(object):
+    """Realtime settings applied to a thread"""
+
+    def __init__(self, name, applied):
+        self.name = name
+        self.applied = applied
+
+
+class RealtimeMode(object):
+    """
+    Optional realtime runtime. The process niceness is lowered, and the MIDI threads (input
+    callbacks, output senders, macro timer) get a SCHED_FIFO priority and are pinned to one CPU,
+    wherever the OS permits it - each thread applies the settings to itself when it starts, as
+    rtmidi creates its own threads. Once started up, every live object is frozen out of the cyclic
+    garbage collector and automatic collections are disabled: a watchdog thread collects between
+    songs, once no MIDI event has been received for gcIdle seconds, or when too many objects are
+    pending. GC pauses and the delays of the watchdog wake-ups (i.e. how late the OS and the GIL
+    let a thread run) are measured, and the ones longer than a MIDI tick are logged.
+    Inactive until applied, entering a thread then does nothing.
+    """
+    def __init__(self, gcIdle=REALTIME_GC_IDLE, maxPending=REALTIME_GC_MAX_PENDING):
+        self.gcIdle = gcIdle
+        self.maxPending = maxPending
+        self.active = False
+        self.cpu = None
+        self.cpus = None                # CPUs of the process before pinning
+        self.process = []
+        self.threads = weakref.WeakSet()    # RealtimeThread of the live threads, gone with their thread
+        self._local = threading.local()     # RealtimeThread of the calling thread, once entered
+        self._failures = set()          # Settings refused by the OS, logged once
+        self._controlled = False
+        self._gcStartedAt = None
+        self._lastCollected = None      # Last event time when the last idle collection ran
+        self._stopping = threading.Event()
+        self._thread = None
+        self.collectCount = 0
+        self.uncontrolledCount = 0
+        self.collectedObjects = 0
+        self.gcPause = Histogram()
+        self.schedulingDelay = Histogram()
+
+    def apply(self, cpu=None):
+        """Raise the process priority and watch the GC pauses, before the ports are opened"""
+        self.active = True
+        self.cpu = cpu
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, REALTIME_NICE)
+            self.process.append("nice %d" % REALTIME_NICE)
+        except (AttributeError, OSError) as e:
+            log.warning("Unable to raise the process priority: %s", e)
+        sys.setswitchinterval(REALTIME_SWITCH_INTERVAL)
+        self.process.append("switch interval %gs" % REALTIME_SWITCH_INTERVAL)
+        if hasattr(os, "sched_getaffinity"):
+            self.cpus = os.sched_getaffinity(0)
+        gc.callbacks.append(self._gc_callback)
+
+    def _refused(self, setting, error):
+        if setting not in self._failures:
+            self._failures.add(setting)
+            log.warning("Realtime mode: %s refused by the OS: %s", setting, error)
+
+    def enter_thread(self):
+        """Apply the CPU pinning and thread priority to the calling thread, once per thread"""
+        if not self.active:
+            return
+        if getattr(self._local, "settings", None) is not None:
+            return
+        applied = []
+        # With pid 0 both calls only change the calling thread on Linux; neither exists on macOS
+        if self.cpu is not None:
+            try:
+                os.sched_setaffinity(0, {self.cpu})
+                applied.append("cpu %d" % self.cpu)
+            except (AttributeError, OSError) as e:
+                self._refused("CPU pinning", e)
+        try:
+            # Threads and processes started from a MIDI thread (e.g. Strobot) do not inherit the priority
+            os.sched_setscheduler(0, os.SCHED_FIFO | getattr(os, "SCHED_RESET_ON_FORK", 0),
+                                  os.sched_param(REALTIME_PRIORITY))
+            applied.append("SCHED_FIFO %d" % REALTIME_PRIORITY)
+        except (AttributeError, OSError) as e:
+            self._refused("SCHED_FIFO priority", e)
+        settings = RealtimeThread(threading.current_thread().name, applied)
+        # Thread ids are reused: the flag lives in the thread-local storage, freed with the thread
+        self._local.settings = settings
+        self.threads.add(settings)
+        log.debug("Realtime settings of thread %s: %s", settings.name, ", ".join(applied) or "none")
+
+    def leave_thread(self):
+        """Undo the CPU pinning inherited by a thread started from a MIDI thread, e.g. before starting a process"""
+        if self.active and self.cpu is not None and self.cpus is not None:
+            try:
+                os.sched_setaffinity(0, self.cpus)
+            except OSError as e:
+                self._refused("CPU unpinning", e)
+
+    def start(self):
+        """Once started up: freeze what startup allocated and leave the collections to the watchdog"""
+        if not self.active or self._thread is not None:
+            return
+        self.collect("startup")
+        gc.disable()
+        log.info("Realtime mode: %d objects frozen, automatic garbage collection disabled", gc.get_freeze_count())
+        self._thread = threading.Thread(target=self._watch, name="realtime-watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _gc_callback(self, phase, info):
+        if phase == "start":
+            self._gcStartedAt = time.perf_counter()
+            return
+        pause = time.perf_counter() - self._gcStartedAt
+        self.gcPause.record(pause)
+        if not self._controlled:
+            self.uncontrolledCount += 1
+            if pause > MIDI_TICK:
+                log.warning("GC pause of %.1f ms outside of the controlled collections (generation %d)",
+                            pause * 1000.0, info["generation"])
+
+    def collect(self, reason):
+        """Controlled full collection, the survivors are frozen again so that the next ones stay short"""
+        start = time.perf_counter()
+        self._controlled = True
+        try:
+            collected = gc.collect()
+            gc.freeze()
+        finally:
+            self._controlled = False
+        self.collectCount += 1
+        self.collectedObjects += collected
+        log.debug("Controlled garbage collection (%s): %d objects in %.1f ms", reason, collected,
+                  (time.perf_counter() - start) * 1000.0)
+
+    def _watch(self):
+        interval = REALTIME_WATCH_INTERVAL
+        self.enter_thread()
+        due = time.perf_counter() + interval
+        while not self._stopping.wait(interval):
+            now = time.perf_counter()
+            delay = max(now - due, 0.0)
+            self.schedulingDelay.record(delay)
+            if delay > MIDI_TICK:
+                log.warning("Realtime watchdog woke up %.1f ms late", delay * 1000.0)
+            pending = gc.get_count()[0]
+            lastEvent = metrics.last_event()
+            if pending > self.maxPending:
+                self.collect("%d objects pending" % pending)
+            elif pending and lastEvent != self._lastCollected and (lastEvent is None or now - lastEvent > self.gcIdle):
+                self._lastCollected = lastEvent
+                self.collect("idle")
+            due = time.perf_counter() + interval
+
+    def stats(self):
+        return {
+            "active"           : self.active,
+            "process"          : self.process,
+            "threads"          : dict((thread.name, thread.applied) for thread in list(self.threads)),
+            "gc_enabled"       : gc.isenabled(),
+            "gc_frozen"        : gc.get_freeze_count(),
+            "gc_pending"       : gc.get_count()[0],
+            "collections"      : self.collectCount,
+            "collected"        : self.collectedObjects,
+            "uncontrolled"     : self.uncontrolledCount,
+            "gc_pause"         : self.gcPause.snapshot(),
+            "scheduling_delay" : self.schedulingDelay.snapshot(),
+        }
+
+    def close(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join(2.0)
+            self._thread = None
+        if self.active:
+            gc.enable()
+            if self._gc_callback in gc.callbacks:
+                gc.callbacks.remove(self._gc_callback)
+
+realtime = RealtimeMode()
+
+
+class StatsRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write((json.dumps(self.server.registry.snapshot()) + "\n").encode("utf-8"))
+
+
+class StatsServer(socketserver.UnixStreamServer):
+    """
+    Publishes the metrics on a local UNIX socket, from its own thread: every connection receives
+    one JSON snapshot, e.g. with `socat - UNIX-CONNECT:/tmp/midi2command.sock`
+    """
+    def __init__(self, path, registry=metrics):
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, StatsRequestHandler)
+        self.path = path
+        self.registry = registry
+        self._thread = threading.Thread(target=self.serve_forever, name="stats-server")
+        self._thread.daemon = True
+        self._thread.start()
+        log.info("Stats published on " + path)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                self.wfile.write((json.dumps(self.server.execute(line)) + "\n").encode("utf-8"))
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Control API on a local UNIX socket, served from its own threads: each line received is a JSON
+    request such as {"command": "reinit"}, answered by one JSON line {"ok": true, "result": ...}
+    or {"ok": false, "error": ...}, with the duration of the command. commands maps each command
+    name to a function taking the request, see control_commands(), e.g.
+    `echo '{"command": "health"}' | socat - UNIX-CONNECT:/tmp/midi2command-control.sock`
+    """
+    daemon_threads = True
+
+    def __init__(self, path, commands):
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, ControlRequestHandler)
+        self.path = path
+        self.commands = commands
+        self.durations = {}
+        self._thread = threading.Thread(target=self.serve_forever, name="control-server")
+        self._thread.daemon = True
+        self._thread.start()
+        log.info("Control API on " + path)
+
+    def execute(self, line):
+        start = time.perf_counter()
+        name = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("A request is a JSON object")
+            name = request.get("command")
+            if name not in self.commands:
+                raise ValueError("Unknown command %r, available: %s" % (name, ", ".join(sorted(self.commands))))
+            response = {"ok": True, "command": name, "result": self.commands[name](request)}
+        except (ValueError, KeyError, TypeError) as e:
+            response = {"ok": False, "command": name, "error": str(e)}
+        except Exception as e:
+            log.exception("Control command %s failed", name)
+            response = {"ok": False, "command": name, "error": repr(e)}
+        duration = time.perf_counter() - start
+        response["duration_ms"] = duration * 1000.0
+        if name in self.commands:
+            self.durations.setdefault(name, Histogram()).record(duration)
+        log.debug("Control command %s: %.2f ms", name, duration * 1000.0)
+        return response
+
+    def stats(self):
+        return dict((name, histogram.snapshot()) for name, histogram in list(self.durations.items()))
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class EventJournal(object):
+    """
+    Binary journal of every MIDI message received by a handler or sent to an output port, for
+    post-show analysis without DEBUG logging. Each message is packed as a fixed-width
+    JOURNAL_RECORD (perf_counter timestamp, rtmidi deltatime, direction, source, length and first
+    3 bytes) into one of two preallocated buffers; a background thread writes the full (or, every
+    JOURNAL_FLUSH_INTERVAL seconds, the partial) buffer while the other one is being filled.
+    Records are dropped, and counted, if both buffers are full. Each file starts with a header
+    giving the source names and the wall clock time of the timestamps, and is rotated once
+    JOURNAL_MAX_BYTES is reached, or when an output port missing from JOURNAL_SOURCES (e.g. a
+    fan-out destination) gets a new source id. Inactive until opened, recording then does nothing.
+    """
+    def __init__(self, capacity=JOURNAL_BUFFER_RECORDS):
+        self.path = None
+        self._capacity = capacity
+        self._buffers = [bytearray(capacity * JOURNAL_RECORD.size) for _ in range(2)]
+        self._active = 0
+        self._used = 0
+        self._pending = None            # (buffer index, record count) waiting to be written
+        self._condition = threading.Condition()
+        self._file = None
+        self._headerSize = 0
+        self._newSources = False        # Sources added since the header of the current file was written
+        self._thread = None
+        self._stopping = False
+        self.sources = list(JOURNAL_SOURCES)
+        self.recordCount = 0
+        self.droppedCount = 0
+        self.rotationCount = 0
+
+    def open(self, path):
+        self.path = path
+        self._open_file()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="journal")
+        self._thread.daemon = True
+        self._thread.start()
+        log.info("Journal written to " + path)
+
+    def _open_file(self):
+        """Start a new journal file, keeping the previous ones as path.1 ... path.JOURNAL_BACKUPS"""
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            for index in range(JOURNAL_BACKUPS - 1, 0, -1):
+                if os.path.exists("%s.%d" % (self.path, index)):
+                    os.replace("%s.%d" % (self.path, index), "%s.%d" % (self.path, index + 1))
+            os.replace(self.path, self.path + ".1")
+        self._file = open(self.path, "wb")
+        self._write_header()
+
+    def _write_header(self):
+        self._newSources = False
+        header = json.dumps({
+            "version"      : 1,
+            "sources"      : list(self.sources),
+            "clock_offset" : time.time() - time.perf_counter(),
+        }).encode("utf-8")
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(JOURNAL_MAGIC + struct.pack("<H", len(header)) + header)
+        self._headerSize = self._file.tell()
+
+    def source(self, key):
+        """Source id of a handler or output port, the ports missing from JOURNAL_SOURCES get the next ids (255 once full)"""
+        with self._condition:
+            if key not in self.sources:
+                if len(self.sources) == 255:
+                    return 255
+                self.sources.append(key)
+                self._newSources = True
+            return self.sources.index(key)
+
+    def record(self, direction, source, message, deltatime, timestamp):
+        """Journal one message - never blocks on the file, safe to call from any thread"""
+        if self._file is None:
+            return
+        length = len(message)
+        with self._condition:
+            if self._used == self._capacity:
+                if self._pending is not None:
+                    self.droppedCount += 1
+                    return
+                self._pending = (self._active, self._used)
+                self._active ^= 1
+                self._used = 0
+                self._condition.notify()
+            JOURNAL_RECORD.pack_into(self._buffers[self._active], self._used * JOURNAL_RECORD.size,
+                                     timestamp, deltatime, direction, source, min(length, 255), message[0],
+                                     message[1] if length > 1 else 0, message[2] if length > 2 else 0)
+            self._used += 1
+            self.recordCount += 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._pending is None and not self._stopping:
+                    self._condition.wait(JOURNAL_FLUSH_INTERVAL)
+                if self._pending is None and self._used:
+                    self._pending = (self._active, self._used)
+                    self._active ^= 1
+                    self._used = 0
+                pending = self._pending
+                stopping = self._stopping
+            if pending is not None:
+                self._write(*pending)
+                with self._condition:
+                    self._pending = None
+            if stopping and pending is None:
+                return
+
+    def _write(self, index, count):
+        try:
+            if self._newSources and self._file.tell() == self._headerSize:
+                self._write_header()
+            elif self._newSources or self._file.tell() + count * JOURNAL_RECORD.size > JOURNAL_MAX_BYTES:
+                # The records already written keep the source names of their file
+                self._file.close()
+                self._open_file()
+                self.rotationCount += 1
+            self._file.write(memoryview(self._buffers[index])[:count * JOURNAL_RECORD.size])
+            self._file.flush()
+        except (IOError, OSError):
+            self.droppedCount += count
+            log.exception("Unable to write the journal")
+
+    def stats(self):
+        return {
+            "path"      : self.path,
+            "records"   : self.recordCount,
+            "dropped"   : self.droppedCount,
+            "rotations" : self.rotationCount,
+        }
+
+    def close(self):
+        if self._thread is None:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join(2.0)
+        self._thread = None
+        journalFile, self._file = self._file, None
+        journalFile.close()
+
+journal = EventJournal()
+
+
+class MacroScheduler(object):
+    """
+    Sends the timed steps of macro sequences from a single timer thread. A trigger pushes the
+    steps into a heap ordered by due time (perf_counter, a monotonic clock) and returns at once;
+    triggering a group again cancels the steps still pending for its previous trigger, which are
+    skipped when they come up. The thread sleeps until spinWindow seconds before the next step,
+    then polls the clock until it is due, to stay well under a millisecond late even when the
+    sleep is not. Polling yields the GIL each time, so that the callbacks are not held up meanwhile.
+    A step is sent to the sender open for its output port when it is due (found in outputs, the
+    senders of the mapping), so that the steps pending across a reinit reach the reopened port.
+    In realtime mode the thread runs SCHED_FIFO on the CPU of the MIDI callbacks, where polling
+    would keep them off the CPU: it only sleeps, its priority keeps the wake-ups on time.
+    """
+    def __init__(self, spinWindow=MACRO_SPIN_WINDOW):
+        self.spinWindow = spinWindow
+        self._heap = []
+        self._counter = 0               # Tie-breaker keeping the steps due at the same time in order
+        self._generations = {}          # Group -> number of its last trigger
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self.outputs = None             # Output key -> open MidiOutputSender, the senders of the mapping
+        self.triggerCount = 0
+        self.sentCount = 0
+        self.cancelledCount = 0
+        self.unsentCount = 0            # Messages of the steps due while their output port was closed
+        self.lateness = Histogram()
+
+    def trigger(self, sequence, port):
+        """Schedule the steps of a sequence on an output port - never blocks, safe to call from a MIDI callback"""
+        now = time.perf_counter()
+        key = getattr(port, "key", None)
+        # Without a key to find its sender again, the steps go to the port given
+        if key is not None and self.outputs is not None:
+            port = None
+        with self._condition:
+            generation = self._generations.get(sequence.group, 0) + 1
+            self._generations[sequence.group] = generation
+            for delay, messages in sequence.steps:
+                self._counter += 1
+                heapq.heappush(self._heap, (now + delay, self._counter, sequence.group, generation, key, port, messages))
+            self.triggerCount += 1
+            self._condition.notify()
+
+    def start(self):
+        """Start the timer thread, ahead of the first trigger: starting a thread blocks until it runs"""
+        with self._condition:
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="macros")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _next_step(self):
+        """Wait until the next live step is about to be due, with the condition lock held. None when stopping"""
+        heap = self._heap
+        spinWindow = 0.0 if realtime.active else self.spinWindow
+        while not self._stopping:
+            if heap and self._generations[heap[0][2]] != heap[0][3]:
+                heapq.heappop(heap)
+                self.cancelledCount += 1
+            elif not heap:
+                self._condition.wait()
+            else:
+                wait = heap[0][0] - time.perf_counter() - spinWindow
+                if wait <= 0:
+                    return heap[0][0]
+                self._condition.wait(wait)
+        return None
+
+    def _run(self):
+        realtime.enter_thread()
+        clock = time.perf_counter
+        while True:
+            with self._condition:
+                due = self._next_step()
+            if due is None:
+                return
+            while clock() < due:
+                time.sleep(0)
+            with self._condition:
+                due, _, group, generation, key, port, messages = heapq.heappop(self._heap)
+                if self._generations[group] != generation:
+                    self.cancelledCount += 1
+                    continue
+            if port is None:
+                port = self.outputs.get(key)
+                if port is None:
+                    self.unsentCount += len(messages)
+                    continue
+            self.lateness.record(clock() - due)
+            for message in messages:
+                port.send_message(message)
+            self.sentCount += len(messages)
+
+    def stats(self):
+        return {
+            "triggers"  : self.triggerCount,
+            "sent"      : self.sentCount,
+            "cancelled" : self.cancelledCount,
+            "unsent"    : self.unsentCount,
+            "pending"   : len(self._heap),
+            "lateness"  : self.lateness.snapshot(),
+        }
+
+    def close(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+macros = MacroScheduler()
+
+
+class CommandStats(object):
+    """Triggers, runs and last result of the command of one rule"""
+    def __init__(self):
+        self.lastTrigger = float("-inf")
+        self.pending = 0
+        self.running = 0
+        self.triggerCount = 0
+        self.debouncedCount = 0
+        self.skippedCount = 0
+        self.runCount = 0
+        self.failedCount = 0
+        self.timeoutCount = 0
+        self.lastExit = None
+        self.lastOutput = ""
+        self.wait = Histogram()
+        self.duration = Histogram()
+
+    def stats(self):
+        return {
+            "triggers"    : self.triggerCount,
+            "debounced"   : self.debouncedCount,
+            "skipped"     : self.skippedCount,
+            "runs"        : self.runCount,
+            "failed"      : self.failedCount,
+            "timeouts"    : self.timeoutCount,
+            "running"     : self.running,
+            "last_exit"   : self.lastExit,
+            "last_output" : self.lastOutput,
+            "wait"        : self.wait.snapshot(),
+            "duration"    : self.duration.snapshot(),
+        }
+
+
+class CommandRunner(object):
+    """
+    Runs the commands of the rules from a pool of worker threads, so that no process is ever
+    started on the MIDI path: a trigger only appends a CommandAction to a bounded queue. A command
+    ignores the triggers received less than its debounce seconds after the previous one, keeps at
+    most one run waiting, and has at most `concurrency` processes at once, the jobs of the other
+    commands going first meanwhile. A process still running after its timeout is killed with its
+    whole process group; if a process which left the group still holds the output pipe, the pipe
+    is closed after COMMAND_KILL_TIMEOUT seconds. The exit code and the end of the output of the
+    last run are kept.
+    """
+    def __init__(self, workers=COMMAND_WORKERS, size=COMMAND_QUEUE_SIZE):
+        self.workers = workers
+        self.size = size
+        self._queue = []                # (queued at, CommandAction), in trigger order
+        self._commands = {}             # Command key -> CommandStats
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self.droppedCount = 0
+
+    def start(self):
+        """Start the workers, ahead of the first trigger"""
+        with self._condition:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name="command-%d" % (len(self._threads) + 1))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, action):
+        """Queue the command of a rule - never blocks, safe to call from a MIDI callback. False if ignored"""
+        now = time.perf_counter()
+        with self._condition:
+            state = self._commands.get(action.key)
+            if state is None:
+                state = self._commands[action.key] = CommandStats()
+            state.triggerCount += 1
+            if now - state.lastTrigger < action.rule.debounce:
+                state.debouncedCount += 1
+                return False
+            state.lastTrigger = now
+            if state.pending:
+                state.skippedCount += 1
+                return False
+            if len(self._queue) >= self.size:
+                self.droppedCount += 1
+                return False
+            state.pending += 1
+            self._queue.append((now, action))
+            self._condition.notify()
+            return True
+
+    def _next_job(self):
+        """First queued job whose command is under its concurrency limit, with the condition lock held. None when stopping"""
+        while not self._stopping:
+            for index, (queuedAt, action) in enumerate(self._queue):
+                state = self._commands[action.key]
+                if state.running < action.rule.concurrency:
+                    del self._queue[index]
+                    state.pending -= 1
+                    state.running += 1
+                    return queuedAt, action, state
+            self._condition.wait()
+        return None
+
+    def _run(self):
+        # The workers may have been started from a MIDI thread
+        realtime.leave_thread()
+        while True:
+            with self._condition:
+                job = self._next_job()
+            if job is None:
+                return
+            queuedAt, action, state = job
+            try:
+                self.execute(action, state, queuedAt)
+            except Exception:
+                log.exception("Command %s failed", action.key)
+            finally:
+                with self._condition:
+                    state.running -= 1
+                    self._condition.notify_all()
+
+    def execute(self, action, state, queuedAt):
+        start = time.perf_counter()
+        state.wait.record(start - queuedAt)
+        log.info("Running command %s: %s", action.key, action.args)
+        try:
+            process = subprocess.Popen(action.args, shell=action.rule.shell, stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+        except (OSError, ValueError) as e:
+            state.failedCount += 1
+            state.lastExit = None
+            state.lastOutput = str(e)
+            log.error("Unable to run command %s: %s", action.key, e)
+            return
+        try:
+            output = process.communicate(timeout=action.rule.timeout)[0]
+        except subprocess.TimeoutExpired:
+            state.timeoutCount += 1
+            log.warning("Command %s still running after %gs, killing it", action.key, action.rule.timeout)
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            try:
+                output = process.communicate(timeout=COMMAND_KILL_TIMEOUT)[0]
+            except subprocess.TimeoutExpired:
+                log.warning("Output of command %s still open after it was killed, closing it", action.key)
+                process.stdout.close()
+                output = b""
+                try:
+                    process.wait(COMMAND_KILL_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    pass
+        state.duration.record(time.perf_counter() - start)
+        state.runCount += 1
+        state.lastExit = process.returncode
+        state.lastOutput = output[-COMMAND_OUTPUT_MAX:].decode("utf-8", "replace")
+        if process.returncode != 0:
+            state.failedCount += 1
+            log.warning("Command %s exited with %s: %s", action.key, process.returncode, state.lastOutput.strip()[-200:])
+        else:
+            log.debug("Command %s done: %s", action.key, state.lastOutput.strip()[-200:])
+
+    def stats(self):
+        with self._condition:
+            return {
+                "queued"   : len(self._queue),
+                "dropped"  : self.droppedCount,
+                "commands" : dict((key, state.stats()) for key, state in self._commands.items()),
+            }
+
+    def close(self):
+        """Stop the workers once their current command is over, the queued ones are not run"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+runner = CommandRunner()
+
+
+def journal_files(path):
+    """Existing files of a journal, oldest first"""
+    paths = ["%s.%d" % (path, index) for index in range(JOURNAL_BACKUPS, 0, -1)] + [path]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def read_journal(path):
+    """Yield the records of one journal file as dicts, with their wall clock time"""
+    with open(path, "rb") as journalFile:
+        if journalFile.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+            raise ValueError(path + " is not a midi2command journal")
+        length, = struct.unpack("<H", journalFile.read(2))
+        header = json.loads(journalFile.read(length).decode("utf-8"))
+        data = journalFile.read()
+    sources = header["sources"]
+    # The last record may be incomplete if the program was killed while writing it
+    data = data[:len(data) - len(data) % JOURNAL_RECORD.size]
+    for timestamp, deltatime, direction, source, length, status, data1, data2 in JOURNAL_RECORD.iter_unpack(data):
+        yield {
+            "time"      : header["clock_offset"] + timestamp,
+            "timestamp" : timestamp,
+            "deltatime" : deltatime,
+            "direction" : "out" if direction == JOURNAL_OUT else "in",
+            "source"    : sources[source] if source < len(sources) else "unknown",
+            "message"   : [status, data1, data2][:length],
+        }
+
+
+class ReinitScheduler(object):
+    """
+    Wakes up the main loop as soon as a MIDI reinitialisation (or resync of the outputs) is
+    requested from a callback. Requests received before the main loop picks them up are coalesced
+    into a single reinit, and the wake-up latency and duration of each reinit are reported.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._resyncs = 0
+        self._requestedAt = None
+        self._startedAt = None
+        self.reinitCount = 0
+        self.coalescedCount = 0
+        self.lastDuration = None
+        self.maxDuration = 0.0
+
+    def request(self):
+        """Ask for a reinit - safe to call from any thread, never blocks on the reinit itself"""
+        with self._lock:
+            if self._pending == 0:
+                self._requestedAt = time.perf_counter()
+            else:
+                self.coalescedCount += 1
+            self._pending += 1
+        self._event.set()
+
+    def request_resync(self):
+        """Ask for a resync of the outputs - safe to call from any thread, the main loop pushes the states"""
+        with self._lock:
+            self._resyncs += 1
+        self._event.set()
+
+    def take_resyncs(self):
+        """Number of resyncs requested since the previous call"""
+        with self._lock:
+            resyncs, self._resyncs = self._resyncs, 0
+        return resyncs
+
+    def wait(self, timeout=None):
+        """
+        Block until a reinit or resync is requested. Return the number of reinit requests it covers,
+        0 on timeout or for a resync only (see take_resyncs())
+        """
+        if not self._event.wait(timeout):
+            return 0
+        with self._lock:
+            self._event.clear()
+            pending, self._pending = self._pending, 0
+            if not pending:
+                return 0
+            self._startedAt = time.perf_counter()
+            latency = self._startedAt - self._requestedAt
+        log.debug("Reinit requested %.2f ms ago (%d request(s))", latency * 1000.0, pending)
+        return pending
+
+    def stats(self):
+        return {
+            "reinits"          : self.reinitCount,
+            "coalesced"        : self.coalescedCount,
+            "last_duration_ms" : None if self.lastDuration is None else self.lastDuration * 1000.0,
+            "max_duration_ms"  : self.maxDuration * 1000.0,
+        }
+
+    def done(self):
+        self.lastDuration = time.perf_counter() - self._startedAt
+        self.maxDuration = max(self.maxDuration, self.lastDuration)
+        self.reinitCount += 1
+        log.info("Reinit #%d done in %.1f ms (max %.1f ms, %d request(s) coalesced so far)",
+                 self.reinitCount, self.lastDuration * 1000.0, self.maxDuration * 1000.0, self.coalescedCount)
+
+
+class StrobotSupervisor(object):
+    """
+    Restarts Strobot from a background thread, so that the MIDI callbacks only have to signal it.
+    The Strobot process is tracked by PID once launched from here (a name lookup is only needed for
+    an instance started by someone else), the relaunch waits for the actual exit of the old process,
+    and requests received within STROBOT_RESTART_DEBOUNCE seconds of the previous one are ignored.
+    """
+    def __init__(self, path=STROBOT_PATH, processName=STROBOT_PROCESS_NAME, debounce=STROBOT_RESTART_DEBOUNCE):
+        self.path = path
+        self.processName = processName
+        self.debounce = debounce
+        self.process = None
+        self._event = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._lastRequest = None
+        self._requestedAt = None
+        self.restartCount = 0
+        self.debouncedCount = 0
+        self.failedCount = 0
+        self.lastLatency = None
+        self.maxLatency = 0.0
+
+    def start(self):
+        """Start the supervisor thread, ahead of the first request: starting a thread blocks until it runs"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="strobot-supervisor")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def request_restart(self):
+        """Ask for a Strobot restart - never blocks, safe to call from a MIDI callback"""
+        now = time.perf_counter()
+        if self._lastRequest is not None and now - self._lastRequest < self.debounce:
+            self.debouncedCount += 1
+            return False
+        self._lastRequest = self._requestedAt = now
+        self._event.set()
+        return True
+
+    def _run(self):
+        realtime.leave_thread()
+        while True:
+            self._event.wait()
+            if self._stopping:
+                return
+            self._event.clear()
+            try:
+                self.restart()
+            except Exception:
+                self.failedCount += 1
+                log.exception("Strobot restart failed")
+
+    def find_processes(self):
+        import psutil
+        if self.process is not None and self.process.poll() is None:
+            return [psutil.Process(self.process.pid)]
+        # Strobot was not launched from here (or already died): look it up by name
+        return [proc for proc in psutil.process_iter(["name"]) if self.processName in (proc.info["name"] or "")]
+
+    def restart(self):
+        import psutil
+        processes = self.find_processes()
+        for proc in processes:
+            log.debug("Killing the process corresponding to Strobot /// PID = " + str(proc.pid))
+            try:
+                proc.kill()
+            except psutil.NoSuchProcess:
+                pass
+        gone, alive = psutil.wait_procs(processes, timeout=STROBOT_EXIT_TIMEOUT)
+        if alive:
+            log.error("Strobot processes still running after being killed: " + ", ".join(str(proc.pid) for proc in alive))
+        if self.process is not None:
+            self.process.poll()
+
+        #Reopen Strobot
+        self.process = subprocess.Popen([self.path])
+        self.lastLatency = time.perf_counter() - self._requestedAt
+        self.maxLatency = max(self.maxLatency, self.lastLatency)
+        self.restartCount += 1
+        log.info("Strobot restarted in %.1f ms (PID = %d, %d restart(s), %d request(s) debounced)",
+                 self.lastLatency * 1000.0, self.process.pid, self.restartCount, self.debouncedCount)
+
+    def stats(self):
+        return {
+            "restarts"       : self.restartCount,
+            "debounced"      : self.debouncedCount,
+            "failed"         : self.failedCount,
+            "last_latency_ms": None if self.lastLatency is None else self.lastLatency * 1000.0,
+            "max_latency_ms" : self.maxLatency * 1000.0,
+            "pid"            : None if self.process is None else self.process.pid,
+        }
+
+    def close(self):
+        self._stopping = True
+        self._event.set()
 
 
 class MidiInputHandler_emergencyControl_Strobot(object):
-    def __init__(self, inputPort):
+    def __init__(self, inputPort, strobotSupervisor=None):
         self.port = inputPort
         self._wallclock = time.time()
+        if strobotSupervisor is None:
+            strobotSupervisor = StrobotSupervisor()
+            strobotSupervisor.start()
+        self.strobotSupervisor = strobotSupervisor
+        self.metrics = metrics.handler("emergency_strobot")
+        self.journalSource = JOURNAL_SOURCES.index("emergency_strobot")
 
     def __call__(self, event, data=None):
+        start = time.perf_counter()
         event, deltatime = event
-        if event[0] < 0xF0:
-            channel = (event[0] & 0xF)
-            status = event[0] & 0xF0
-        else:
-            status = event[0]
-            channel = None
-
-        data1 = data2 = None
-        num_bytes = len(event)
-        if num_bytes >= 2:
-            data1 = event[1]
-        if num_bytes >= 3:
-            data2 = event[2]
-        
-        # Add 1 to channel (Ch 1 is coded ass Ch 0)
-        if channel + 1 == STROBOT_REINIT_CHANNEL and data1 == STROBOT_REINIT_PITCH and data2 != 0:
+        journal.record(JOURNAL_IN, self.journalSource, event, deltatime, start)
+        status, channel = STATUS_DECODE[event[0]]
+        data1 = event[1] if len(event) >= 2 else None
+        data2 = event[2] if len(event) >= 3 else None
+
+        # Channels are numbered from 1 in the configuration (Ch 1 is coded as Ch 0)
+        if channel == STROBOT_REINIT_CHANNEL - 1 and data1 == STROBOT_REINIT_PITCH and data2 != 0:
             self.execute_strobot_reinit_script()
+        self.metrics.record(event, deltatime, start, time.perf_counter())
 
 
     def execute_strobot_reinit_script(self):
         log.debug("--- EXECUTING STROBOT REINITIALISATION SCRIPT ! ---")
-        PROCNAME1 = "Strobot"
-        
-        for proc in psutil.process_iter():
-            if PROCNAME1 in str(proc.name):
-                log.debug("Found the process corresponding to Strobot : " + str(proc.name) + " /// PID = " + str(proc.pid))
-                proc.kill()
-
-        time.sleep(2)      # Wait 2 seconds before restarting the main process
-        #Reopen Strobot
-        p1 = subprocess.Popen(STROBOT_PATH, shell=True).pid
+        self.strobotSupervisor.request_restart()
 
     def close(self):
         pass
 
 class MidiInputHandler_emergencyControl_MIDI(object):
-    def __init__(self, inputPort, abletonOut):
+    def __init__(self, inputPort, reinitScheduler=None, strobotSupervisor=None, resync=None):
         self.port = inputPort
         self._wallclock = time.time()
-        self.midiout_abletonOut = abletonOut
-        self.midiport_guitarWing_available = False
-        self.midiport_abletonInGtr_available = False
-        self.midiport_audioItf_available = False
-        self.reinitialize_midiinputs()
+        self.resync = resync
+        if strobotSupervisor is None:
+            strobotSupervisor = StrobotSupervisor()
+            strobotSupervisor.start()
+        self.strobotSupervisor = strobotSupervisor
+        self.reinitScheduler = reinitScheduler or ReinitScheduler()
+        self.metrics = metrics.handler("emergency_midi")
+        self.journalSource = JOURNAL_SOURCES.index("emergency_midi")
 
     def __call__(self, event, data=None):
+        start = time.perf_counter()
         event, deltatime = event
-        if event[0] < 0xF0:
-            channel = (event[0] & 0xF)
-            status = event[0] & 0xF0
-        else:
-            status = event[0]
-            channel = None
-
-        data1 = data2 = None
-        num_bytes = len(event)
-        if num_bytes >= 2:
-            data1 = event[1]
-        if num_bytes >= 3:
-            data2 = event[2]
-        
-        # Add 1 to channel (Ch 1 is coded ass Ch 0)
-        if channel + 1 == MIDI_REINIT_CHANNEL and data1 == MIDI_REINIT_PITCH and data2 != 0:
+        journal.record(JOURNAL_IN, self.journalSource, event, deltatime, start)
+        status, channel = STATUS_DECODE[event[0]]
+        data1 = event[1] if len(event) >= 2 else None
+        data2 = event[2] if len(event) >= 3 else None
+
+        # Channels are numbered from 1 in the configuration (Ch 1 is coded as Ch 0)
+        if channel == MIDI_REINIT_CHANNEL - 1 and data1 == MIDI_REINIT_PITCH and data2 != 0:
             log.info("Reinitialize the necessary MIDI inputs/outputs")
-            global REINIT_CALL
-            REINIT_CALL = True
+            self.reinitScheduler.request()
 
-        if channel + 1 == STROBOT_REINIT_CHANNEL and data1 == STROBOT_REINIT_PITCH and data2 != 0:
+        if channel == MIDI_RESYNC_CHANNEL - 1 and data1 == MIDI_RESYNC_PITCH and data2 != 0 and self.resync is not None:
+            log.info("Resync the state of the MIDI outputs")
+            self.resync()
+
+        if channel == STROBOT_REINIT_CHANNEL - 1 and data1 == STROBOT_REINIT_PITCH and data2 != 0:
             self.execute_strobot_reinit_script()
+        self.metrics.record(event, deltatime, start, time.perf_counter())
 
 
     def execute_strobot_reinit_script(self):
         log.debug("--- EXECUTING STROBOT REINITIALISATION SCRIPT ! ---")
-        PROCNAME1 = "Strobot"
-        
-        for proc in psutil.process_iter():
-            if PROCNAME1 in str(proc.name):
-                log.debug("Found the process corresponding to Strobot : " + str(proc.name) + " /// PID = " + str(proc.pid))
-                proc.kill()
+        self.strobotSupervisor.request_restart()
 
-        time.sleep(2)      # Wait 2 seconds before restarting the main process
-        #Reopen Strobot
-        p1 = subprocess.Popen(STROBOT_PATH, shell=True).pid
-
-    def reinitialize_midiinputs(self):
-
-        # If the ports are already open, close them before reopening them
-        if self.midiport_guitarWing_available:
-            self.midiin_guitarWing.close_port()
-            # del self.midiin_guitarWing
-        if self.midiport_audioItf_available:
-            self.midiout_audioItf.close_port()
-            # del self.midiout_audioItf
-        self.midiport_guitarWing_available = False
-        self.midiport_audioItf_available = False
-
-        global MIDI_BUS_CONFIGURATION_EMERGENCY_CONTROL
-        global MIDI_BUS_CONFIGURATION_GUITAR_WING
-        global MIDI_BUS_CONFIGURATION_ABLETON_IN_VOICE_FX
-        global MIDI_BUS_CONFIGURATION_ABLETON_OUT
-        global MIDI_BUS_CONFIGURATION_ABLETON_IN_GTR
-        global MIDI_BUS_CONFIGURATION_AUDIO_INTERFACE_OUT
-        #Try to initialize the MIDI ports which might not be available all the time
+    def close(self):
+        pass
+
+
+class RoutingTable(object):
+    """
+    Flat lookup table indexed by (status, channel, data1), compiled once from the mapping rules.
+    Each populated slot holds 128 tuples of prebuilt outgoing messages, indexed by data2, so that
+    a callback does a single lookup before sending.
+    """
+    NO_MESSAGES = ()
+
+    def __init__(self):
+        self.slots = [None] * ROUTE_COUNT
+        self.offsets = ROUTE_OFFSETS
+
+    def slot_index(self, status, channel, data1):
+        return self.offsets[status + channel] + data1
+
+    def add_row(self, status, channel, data1, row):
+        """Route the events of one (status, channel, data1) to row[data2], unless an earlier rule already routes them"""
+        index = self.slot_index(status, channel, data1)
+        slot = self.slots[index]
+        if slot is None:
+            self.slots[index] = list(row)
+            return
+        for data2, messages in enumerate(row):
+            if messages and not slot[data2]:
+                slot[data2] = messages
+
+    def lookup(self, event):
+        offset = self.offsets[event[0]]
+        if offset < 0 or len(event) < 3:
+            return self.NO_MESSAGES
+        slot = self.slots[offset + event[1]]
+        if slot is None:
+            return self.NO_MESSAGES
+        return slot[event[2]]
+
+
+def compile_routes(commands):
+    """Compile a list of Command rules into a RoutingTable"""
+    routes = RoutingTable()
+    for command in commands:
+        if command.status not in ROUTED_STATUSES:
+            log.warning("Rule '%s' ignored: status 0x%02X cannot be routed", command.name, command.status)
+            continue
+        channels, data1_values, data2_values = command.matched_values()
+        # Messages are only built once per value of the data bytes they depend on, and unless an
+        # output byte takes data1, the same row of 128 entries serves every data1 and channel matched
+        used = command.used_data()
+        built = {}
+        row = None
+        for data1 in data1_values:
+            if row is None or 1 in used:
+                row = [RoutingTable.NO_MESSAGES] * 128
+                for data2 in data2_values:
+                    key = (data1 if 1 in used else None, data2 if 2 in used else None)
+                    if key not in built:
+                        built[key] = command.build_messages(*key)
+                    row[data2] = built[key]
+            for channel in channels:
+                routes.add_row(command.status, channel, data1, row)
+    return routes
+
+
+def fanout_message(message, destination):
+    """
+    Copy of an outgoing message for a fan-out destination, None if its filter rejects it. The
+    channel is remapped, and the last data byte goes through the "transform" (as an output byte
+    taken from it, see DEFAULT_MAPPING)
+    """
+    status, channel = STATUS_DECODE[message[0]]
+    rules = destination.get("filter", {})
+    if "status" in rules and status not in [STATUS_NAMES.get(name, name) for name in rules["status"]]:
+        return None
+    if "channel" in rules and (channel is None or channel + 1 not in rules["channel"]):
+        return None
+    if "data1" in rules and (len(message) < 2 or message[1] not in rules["data1"]):
+        return None
+    message = list(message)
+    if "channel" in destination and channel is not None:
+        message[0] = status | (destination["channel"] - 1)
+    if "transform" in destination and len(message) >= 2:
+        spec = dict(destination["transform"], **{"from": "data2"})
+        message[-1] = output_byte(spec, None, min(message[-1], 127))
+    return cached_message(message)
+
+
+def check_fanout_destination(destination):
+    """Raise ValueError if a fan-out destination could turn the messages into other types or drop them all"""
+    if "channel" in destination and not (isinstance(destination["channel"], int) and 1 <= destination["channel"] <= 16):
+        raise ValueError("Fan-out channel %r is not in 1-16" % (destination["channel"],))
+    for name in destination.get("filter", {}).get("status", []):
+        status = STATUS_NAMES.get(name, name)
+        if not (isinstance(status, int) and 0x80 <= status <= 0xFF and (status >= 0xF0 or status & 0x0F == 0)):
+            raise ValueError("Unknown fan-out filter status %r, use %s or a status byte" % (name, ", ".join(sorted(STATUS_NAMES))))
+    if "transform" in destination:
+        output_table(dict(destination["transform"], **{"from": "data2"}))
+
+
+def apply_fanout(table, destinations, senders):
+    """Append to every entry of a routing table the FanOut of its messages for each destination"""
+    extended = {}
+    for slot in table.slots:
+        if slot is None:
+            continue
+        for data2, messages in enumerate(slot):
+            if not messages:
+                continue
+            if messages not in extended:
+                actions = []
+                for destination in destinations:
+                    copies = [fanout_message(message, destination) for message in messages if not isinstance(message, RouteAction)]
+                    copies = tuple(copy for copy in copies if copy is not None)
+                    if copies:
+                        actions.append(FanOut(destination["output"], copies, senders))
+                extended[messages] = messages + tuple(actions)
+            slot[data2] = extended[messages]
+    return table
+
+
+def parse_rate_limits(output):
+    """(channel, controller) -> max messages per second, from the settings of an output port"""
+    limits = {}
+    for limit in output.get("rate_limits", []):
+        channel, controller, maxRate = limit["channel"], limit["controller"], float(limit["max_rate"])
+        if not (isinstance(channel, int) and 1 <= channel <= 16
+                and isinstance(controller, int) and 0 <= controller <= 127):
+            raise ValueError("Rate limit on channel %r, controller %r: channels are 1-16, controllers 0-127" % (channel, controller))
+        if maxRate <= 0:
+            raise ValueError("Rate limit on channel %d, controller %d: max_rate must be positive" % (channel, controller))
+        limits[(channel - 1, controller)] = maxRate
+    return limits
+
+
+class SetlistTracker(object):
+    """
+    Follows the program changes sent to an output port along the setlist, i.e. the programs of
+    the show in order. Once a preset is active, the "preload" messages of the next one are sent
+    (with data1 being its program), e.g. a bank select, so that the switch itself is a single
+    program change at the downbeat. A switch to the predicted program is a hit; any other is a
+    miss, and the position jumps to the next occurrence of that program in the setlist.
+    The time each switch waited in the output queue, from the handler queuing the program change
+    until the port took it, is measured (the latency from the input event which triggered it is
+    measured from the journal, see midi2command_journal.py setlist). Runs in the sender thread of
+    the port, after each message is sent.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.channel = config["channel"] - 1
+        self.presets = [int(program) for program in config["presets"]]
+        if not self.presets:
+            raise ValueError("Empty setlist")
+        preload = Command(name="setlist preload", output=config.get("preload", []))
+        self._preloads = [preload.build_messages(program, 0) for program in self.presets]
+        self.position = -1
+        self.hitCount = 0
+        self.missCount = 0
+        self.queueLatency = Histogram()
+
+    def predicted(self):
+        index = self.position + 1
+        return self.presets[index] if index < len(self.presets) else None
+
+    def attach(self, sender):
+        sender.watcher = self.sent
+        self.send_preload(sender)
+
+    def send_preload(self, sender):
+        index = self.position + 1
+        if index < len(self.presets):
+            for message in self._preloads[index]:
+                sender.send_message(message)
+
+    def sent(self, sender, message, queuedAt, sentAt):
+        if message[0] != STATUS_PC + self.channel or len(message) < 2:
+            return
+        program = message[1]
+        if self.position >= 0 and self.presets[self.position] == program:
+            return              # Same preset again, e.g. resent by a resync
+        self.queueLatency.record(sentAt - queuedAt)
+        if program == self.predicted():
+            self.hitCount += 1
+            self.position += 1
+        else:
+            self.missCount += 1
+            following = [index for index in range(self.position + 1, len(self.presets)) if self.presets[index] == program]
+            anywhere = [index for index in range(len(self.presets)) if self.presets[index] == program]
+            if not (following or anywhere):
+                log.info("Program %d is not in the setlist, staying at position %d", program, self.position + 1)
+                return
+            self.position = (following or anywhere)[0]
+        log.info("Setlist position %d/%d: program %d, next %s", self.position + 1, len(self.presets), program, self.predicted())
+        self.send_preload(sender)
+
+    def reset(self):
+        self.position = -1
+
+    def stats(self):
+        return {
+            "position"      : self.position + 1,
+            "length"        : len(self.presets),
+            "predicted"     : self.predicted(),
+            "hits"          : self.hitCount,
+            "misses"        : self.missCount,
+            "queue_latency" : self.queueLatency.snapshot(),
+        }
+
+
+class MidiMapping(object):
+    """
+    Routing rules and port names, loaded from a JSON mapping file (or YAML if PyYAML is installed)
+    and compiled into one RoutingTable per handler. Anything the file does not define falls back
+    to DEFAULT_MAPPING and DEFAULT_PORTS.
+    The file can be watched: new tables are swapped into the registered handlers in a single
+    assignment each, so an event being routed finishes on the tables it started with. Compiling
+    and swapping are separate steps, so that the asyncio runtime can compile off its loop.
+    Rules can be disabled by name, or whole tables, until enabled again: they are left out of
+    the tables, including after a reload of the file.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.config = {}
+        self.rules = {}
+        self.disabled = set()           # (table, rule name), the rule name being None for the whole table
+        self.ports = dict(DEFAULT_PORTS)
+        self.outputs = {}
+        self.tables = {}
+        self.handlers = weakref.WeakSet()
+        self.senders = {}
+        self.setlists = {}
+        self.fanout = {}
+        self._mtime = None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._watcher = None
+        self.load()
+
+    def read_file(self):
+        with open(self.path) as mappingFile:
+            if self.path.endswith((".yaml", ".yml")):
+                try:
+                    import yaml
+                except ImportError:
+                    raise ValueError("PyYAML is required to read " + self.path)
+                try:
+                    config = yaml.safe_load(mappingFile) or {}
+                except yaml.YAMLError as e:
+                    raise ValueError(str(e))
+            else:
+                config = json.load(mappingFile)
+        if not isinstance(config, dict):
+            raise ValueError("The mapping is not an object with routes, ports... sections")
+        return config
+
+    def load(self, reread=True):
+        """
+        (Re)load the mapping file and swap in the new tables. Keeps the current tables if the file
+        is invalid. Without reread, the tables are only compiled again from the last valid file
+        """
+        with self._lock:
+            compiled = self.compile(reread)
+            if compiled is None:
+                return False
+            self.swap(compiled)
+            return True
+
+    def compile(self, reread=True):
+        """Read the mapping file and compile it for swap(), without touching the handlers. None to keep the current tables"""
+        with self._lock:
+            config = {} if reread else self.config
+            if self.path is not None and reread:
+                try:
+                    self._mtime = os.stat(self.path).st_mtime
+                    config = self.read_file()
+                    log.info("Loaded mapping file " + self.path)
+                except (IOError, OSError, ValueError) as e:
+                    log.error("Unable to load mapping file %s: %s", self.path, e)
+                    if self.tables:
+                        return None
+
+            try:
+                rules = dict(DEFAULT_MAPPING["routes"])
+                rules.update(config.get("routes", {}))
+                ports = dict(DEFAULT_PORTS)
+                ports.update(config.get("ports", {}))
+                fanout = config.get("fanout", {})
+                tables = {}
+                for name, commands in rules.items():
+                    tables[name] = compile_routes([rule for rule in [Command(**command) for command in commands] if self.enabled(name, rule)])
+                    for destination in fanout.get(name, []):
+                        if destination["output"] not in ports:
+                            raise ValueError("No port name for the fan-out output " + repr(destination["output"]))
+                        check_fanout_destination(destination)
+                    if fanout.get(name):
+                        apply_fanout(tables[name], fanout[name], self.senders)
+                outputs = dict(DEFAULT_MAPPING["outputs"])
+                outputs.update(config.get("outputs", {}))
+                setlists = {}
+                for key in outputs:
+                    parse_rate_limits(outputs[key])
+                    if "setlist" in outputs[key]:
+                        # An unchanged setlist keeps its position
+                        previous = self.setlists.get(key)
+                        if previous is not None and previous.config == outputs[key]["setlist"]:
+                            setlists[key] = previous
+                        else:
+                            setlists[key] = SetlistTracker(outputs[key]["setlist"])
+            except (TypeError, ValueError, KeyError, AttributeError, IndexError) as e:
+                log.error("Invalid mapping file %s: %s", self.path, e)
+                if self.tables:
+                    return None
+                rules = DEFAULT_MAPPING["routes"]
+                tables = dict((name, compile_routes([rule for rule in [Command(**command) for command in commands] if self.enabled(name, rule)]))
+                              for name, commands in rules.items())
+                config = {}
+                outputs = dict(DEFAULT_MAPPING["outputs"])
+                setlists = {}
+                fanout = {}
+                ports = dict(DEFAULT_PORTS)
+            return config, rules, ports, tables, outputs, fanout, setlists
+
+    def swap(self, compiled):
+        """Swap the tables and settings returned by compile() into the handlers and output senders"""
+        config, rules, ports, tables, outputs, fanout, setlists = compiled
+        with self._lock:
+            if self.tables and ports != self.ports:
+                log.info("Port names changed in the mapping file, the ports will be reopened")
+            self.ports = ports
+
+            self.config = config
+            self.rules = dict((name, [command.get("name") for command in commands]) for name, commands in rules.items())
+            self.tables = tables
+            self.outputs = outputs
+            self.fanout = fanout
+            replaced = [key for key in set(setlists) | set(self.setlists) if setlists.get(key) is not self.setlists.get(key)]
+            self.setlists = setlists
+            for handler in list(self.handlers):
+                handler.set_routes(self.routes(handler.ROUTES))
+            for key, sender in list(self.senders.items()):
+                sender.set_rate_limits(self.rate_limits(key))
+                if key in replaced:
+                    self.attach_setlist(key, sender)
+
+    def enabled(self, table, rule):
+        """False if the Command rule, or its whole table, is disabled"""
+        return (table, None) not in self.disabled and (table, rule.name) not in self.disabled
+
+    def set_enabled(self, table, name=None, enabled=True):
+        """Enable or disable a rule of a table by name, or the whole table, and compile the tables again"""
+        if table not in self.rules:
+            raise ValueError("No routing table " + repr(table))
+        if name is not None and name not in self.rules[table]:
+            raise ValueError("No rule %r in table %r" % (name, table))
+        if enabled:
+            self.disabled.discard((table, name))
+        else:
+            self.disabled.add((table, name))
+        self.load(reread=False)
+        return self.disabled_rules()
+
+    def disabled_rules(self):
+        return [{"table": table, "rule": name} for table, name in sorted(self.disabled, key=lambda item: (item[0], item[1] or ""))]
+
+    def rate_limits(self, key):
+        return parse_rate_limits(self.outputs.get(key, {}))
+
+    def register_output(self, key, sender):
+        """Give an output sender the rate limits and setlist of its port, and keep them updated when the mapping file changes"""
+        self.senders[key] = sender
+        sender.set_rate_limits(self.rate_limits(key))
+        self.attach_setlist(key, sender)
+
+    def attach_setlist(self, key, sender):
+        tracker = self.setlists.get(key)
+        if tracker is not None:
+            tracker.attach(sender)
+        else:
+            sender.watcher = None
+
+    def unregister_output(self, key, sender):
+        if self.senders.get(key) is sender:
+            del self.senders[key]
+
+    def fanout_outputs(self):
+        """Keys of the output ports only used as fan-out destinations"""
+        return sorted(set(destination["output"] for destinations in list(self.fanout.values()) for destination in destinations))
+
+    def setlist_stats(self):
+        return dict((key, tracker.stats()) for key, tracker in list(self.setlists.items()))
+
+    def routes(self, name):
+        return self.tables.get(name) or RoutingTable()
+
+    def register(self, handler):
+        """Give a handler its current table, and keep it updated when the mapping file changes"""
+        self.handlers.add(handler)
+        handler.set_routes(self.routes(handler.ROUTES))
+
+    def watch(self, interval=MAPPING_WATCH_INTERVAL):
+        if self.path is None or self._watcher is not None:
+            return
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name="mapping-watcher")
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def changed(self):
+        """True if the mapping file changed since it was last loaded"""
         try:
-            self.midiin_guitarWing, self.port_name_guitarWing     = open_midiport(MIDI_BUS_CONFIGURATION_GUITAR_WING, type_ = "input", interactive=False)
-            self.midiport_guitarWing_available = True
-        except (ValueError):
-            log.info("Input Guitar Wing MIDI port unavailable")
+            return os.stat(self.path).st_mtime != self._mtime
+        except OSError:
+            return False
+
+    def check(self):
+        """Reload the mapping file if it changed since it was last loaded"""
+        if not self.changed():
+            return False
+        log.info("Mapping file changed, reloading it")
+        return self.load()
+
+    def _watch(self, interval):
+        while not self._stop.wait(interval):
+            # Whatever is wrong with the file, keep watching it for the fix
+            try:
+                self.check()
+            except Exception:
+                log.exception("Unable to reload mapping file " + str(self.path))
+
+    def close(self):
+        self._stop.set()
 
-        if self.midiport_abletonInGtr_available == False:
+
+class OutputState(object):
+    """
+    Last value sent for each (channel, controller) and last program sent on each channel of one
+    output port. Kept by the port manager across handler recreations and port reopenings, so that
+    exact duplicates are never sent, and the whole state can be pushed again after a reconnection
+    """
+    def __init__(self):
+        self.controllers = array.array('h', [-1]) * (16 * 128)
+        self.programs = array.array('h', [-1]) * 16
+        self.suppressedCount = 0
+
+    def update(self, message):
+        """Record a message about to be sent, and return False if it would not change the cached state"""
+        status = message[0] & 0xF0
+        if status == STATUS_CC:
+            key = (message[0] & 0x0F) << 7 | message[1]
+            if self.controllers[key] == message[2]:
+                self.suppressedCount += 1
+                return False
+            self.controllers[key] = message[2]
+        elif status == STATUS_PC:
+            channel = message[0] & 0x0F
+            if self.programs[channel] == message[1]:
+                self.suppressedCount += 1
+                return False
+            self.programs[channel] = message[1]
+        return True
+
+    def forget(self, message):
+        """Undo update() for a message which was finally not sent, unless a newer value was recorded since"""
+        status = message[0] & 0xF0
+        if status == STATUS_CC:
+            key = (message[0] & 0x0F) << 7 | message[1]
+            if self.controllers[key] == message[2]:
+                self.controllers[key] = -1
+        elif status == STATUS_PC:
+            channel = message[0] & 0x0F
+            if self.programs[channel] == message[1]:
+                self.programs[channel] = -1
+
+    def messages(self):
+        """The messages restoring the whole cached state: programs first, then controllers"""
+        messages = [cached_message([STATUS_PC + channel, program])
+                    for channel, program in enumerate(self.programs) if program >= 0]
+        messages += [cached_message([STATUS_CC + (key >> 7), key & 0x7F, value])
+                     for key, value in enumerate(self.controllers) if value >= 0]
+        return messages
+
+    def stats(self):
+        return {
+            "controllers" : sum(1 for value in self.controllers if value >= 0),
+            "programs"    : dict((channel + 1, program) for channel, program in enumerate(self.programs) if program >= 0),
+            "suppressed"  : self.suppressedCount,
+        }
+
+
+class MidiOutputSender(object):
+    """
+    Sends the messages of one output port from a dedicated thread, so that a slow port cannot
+    back up the input callbacks. Callbacks push messages into a preallocated ring buffer; a CC
+    still waiting to be sent for the same (channel, controller), and queued less than
+    coalesceWindow seconds ago, is replaced by the new value instead of queuing another message.
+    Messages are never delayed to be coalesced, and the newest message is dropped when the
+    buffer is full. With an OutputState, CC and program changes which would not change the state
+    of the device are not sent at all, and a dropped message is taken out of the state again
+    (except those of a resync, which stops at its timeout). Rate-limited controllers hold the
+    values received too soon after the previous one, and the sender thread flushes the last one
+    held when its delay is over, unless it went back to the value last queued.
+    A RouteAction sent as a message (MacroSequence, FanOut) is dispatched instead of being queued.
+    A port with a flush() method (network ports) is flushed whenever the queue is empty, so that
+    the messages of a burst are sent together.
+    Drop-in replacement for the rtmidi port in the handlers.
+    """
+    def __init__(self, port, name="", size=OUTPUT_QUEUE_SIZE, coalesceWindow=OUTPUT_CC_COALESCE_WINDOW, state=None, key=None):
+        self.port = port
+        self.name = name
+        self.key = key
+        self.journalSource = journal.source(key) if key is not None else 255
+        self._flush = getattr(port, "flush", None)
+        self.state = state
+        self.coalesceWindow = coalesceWindow
+        self._size = size
+        self._buffer = [None] * size
+        self._queuedAt = [0.0] * size
+        self._keys = [-1] * size
+        # (channel << 7 | controller) -> buffer index of the CC waiting to be sent, -1 if none
+        self._pendingCC = [-1] * (16 * 128)
+        # (channel << 7 | controller) -> minimum seconds between two values (0 when not limited),
+        # time the last value was queued, and value held until that delay is over
+        self._minInterval = array.array('d', [0.0]) * (16 * 128)
+        self._lastQueuedAt = array.array('d', [0.0]) * (16 * 128)
+        self._held = [None] * (16 * 128)
+        self._heldKeys = []
+        self._lastPushed = array.array('h', [-1]) * (16 * 128)   # Last value queued per controller
+        self._head = 0                  # Total number of messages taken by the sender thread
+        self._tail = 0                  # Total number of messages queued
+        self._condition = threading.Condition()
+        self._stopping = False
+        self.sentCount = 0
+        self.coalescedCount = 0
+        self.droppedCount = 0
+        self.heldCount = 0
+        self.maxDepth = 0
+        self.watcher = None             # Called with (sender, message, queuedAt, sentAt) after each message sent
+        self.queueTime = Histogram()
+        self.sendTime = Histogram()
+        self._thread = threading.Thread(target=self._run, name="midi-out " + name)
+        self._thread.daemon = True
+        self._thread.start()
+        metrics.register_output(self)
+
+    def send_message(self, message):
+        if isinstance(message, RouteAction):
+            message.dispatch(self)
+            return
+        with self._condition:
+            if self.state is not None and not self.state.update(message):
+                return
+            self._queue(message)
+
+    def set_rate_limits(self, limits):
+        """Set the max rate of the limited controllers, from a (channel, controller) -> max_rate dict"""
+        with self._condition:
+            for key in range(16 * 128):
+                self._minInterval[key] = 0.0
+            for (channel, controller), maxRate in limits.items():
+                self._minInterval[channel << 7 | controller] = 1.0 / maxRate if maxRate > 0 else 0.0
+            self._condition.notify()
+
+    def resync(self, timeout=OUTPUT_RESYNC_TIMEOUT):
+        """
+        Push the whole cached state of the device again, e.g. after it reconnected. Waits for room in
+        the queue (up to timeout seconds in all) rather than dropping the state, so not from a callback
+        """
+        if self.state is None:
+            return 0
+        messages = self.state.messages()
+        if not messages:
+            return 0
+        deadline = time.perf_counter() + timeout
+        pushed = 0
+        with self._condition:
+            for message in messages:
+                while self._tail - self._head >= self._size and time.perf_counter() < deadline and not self._stopping:
+                    self._condition.wait(0.001)
+                if self._tail - self._head >= self._size:
+                    break
+                # The state is what the device should be in, it stays whole for the next resync
+                self._push(message, time.perf_counter(), forget=False)
+                pushed += 1
+        if pushed < len(messages):
+            log.warning("Resync of %s: %d of %d message(s) not sent, the port is too slow", self.name, len(messages) - pushed, len(messages))
+        else:
+            log.info("Resync of %s: %d message(s) sent", self.name, pushed)
+        return pushed
+
+    def _queue(self, message):
+        """Put a message in the ring buffer, or hold it if its controller is rate-limited, with the condition lock held"""
+        now = time.perf_counter()
+        if message[0] & 0xF0 == STATUS_CC:
+            key = (message[0] & 0x0F) << 7 | message[1]
+            if self._minInterval[key] and now - self._lastQueuedAt[key] < self._minInterval[key]:
+                if self._held[key] is None:
+                    self._heldKeys.append(key)
+                    self._condition.notify()
+                self._held[key] = message
+                self.heldCount += 1
+                return
+        self._push(message, now)
+
+    def _push(self, message, now, forget=True):
+        key = -1
+        if message[0] & 0xF0 == STATUS_CC:
+            key = (message[0] & 0x0F) << 7 | message[1]
+            self._lastQueuedAt[key] = now
+            index = self._pendingCC[key]
+            if index >= 0 and now - self._queuedAt[index] < self.coalesceWindow:
+                self._buffer[index] = message
+                self._lastPushed[key] = message[2]
+                self.coalescedCount += 1
+                return
+        depth = self._tail - self._head
+        if depth >= self._size:
+            self.droppedCount += 1
+            if self.state is not None and forget:
+                self.state.forget(message)
+            return
+        index = self._tail % self._size
+        self._buffer[index] = message
+        self._queuedAt[index] = now
+        self._keys[index] = key
+        if key >= 0:
+            self._pendingCC[key] = index
+            self._lastPushed[key] = message[2]
+        self._tail += 1
+        if depth >= self.maxDepth:
+            self.maxDepth = depth + 1
+        self._condition.notify()
+
+    def _flush_held(self):
+        """Queue the held values whose delay is over (all of them when stopping), return the seconds until the next one"""
+        now = time.perf_counter()
+        timeout = None
+        for key in list(self._heldKeys):
+            wait = self._lastQueuedAt[key] + self._minInterval[key] - now
+            if wait <= 0 or self._stopping:
+                held = self._held[key]
+                # The state was updated when the value was held: back to the value last queued, nothing to send
+                if self.state is not None and held[2] == self._lastPushed[key]:
+                    self.state.suppressedCount += 1
+                else:
+                    self._push(held, now)
+                self._held[key] = None
+                self._heldKeys.remove(key)
+            elif timeout is None or wait < timeout:
+                timeout = wait
+        return timeout
+
+    def _run(self):
+        realtime.enter_thread()
+        condition = self._condition
+        while True:
+            with condition:
+                while True:
+                    timeout = self._flush_held() if self._heldKeys else None
+                    if self._head != self._tail or self._stopping:
+                        break
+                    condition.wait(timeout)
+                if self._head == self._tail:
+                    return
+                index = self._head % self._size
+                message = self._buffer[index]
+                queuedAt = self._queuedAt[index]
+                self._buffer[index] = None
+                key = self._keys[index]
+                if key >= 0 and self._pendingCC[key] == index:
+                    self._pendingCC[key] = -1
+                self._head += 1
+            start = time.perf_counter()
             try:
-                self.midiin_abletonInGtr, self.port_name_abletonInGtr = open_midiport(MIDI_BUS_CONFIGURATION_ABLETON_IN_GTR, type_ = "input", interactive=False)
-                self.midiport_abletonInGtr_available = True
-            except (ValueError):
-                log.info("Input Ableton Gtr MIDI port unavailable")
+                self.port.send_message(message)
+                journal.record(JOURNAL_OUT, self.journalSource, message, 0.0, start)
+                end = time.perf_counter()
+                self.sentCount += 1
+                self.queueTime.record(start - queuedAt)
+                self.sendTime.record(end - start)
+                if self.watcher is not None:
+                    self.watcher(self, message, queuedAt, end)
+                if self._flush is not None and self._head == self._tail:
+                    self._flush()
+            except Exception:
+                log.exception("Unable to send a MIDI message to " + self.name)
+
+    def depth(self):
+        return self._tail - self._head
+
+    def stats(self):
+        return {
+            "depth"     : self.depth(),
+            "max_depth" : self.maxDepth,
+            "sent"      : self.sentCount,
+            "coalesced" : self.coalescedCount,
+            "dropped"   : self.droppedCount,
+            "held"      : self.heldCount,
+            "state"     : None if self.state is None else self.state.stats(),
+            "queue"     : self.queueTime.snapshot(),
+            "send"      : self.sendTime.snapshot(),
+        }
+
+    def close_port(self):
+        """Send what is still queued, then close the underlying port"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join(1.0)
+        log.debug("Output %s closed: %r", self.name, self.stats())
+        self.port.close_port()
+
+
+class MissingOutput(object):
+    """
+    Output of a handler while its output port is closed: the RouteActions (fan-out to the other
+    ports, commands, macro sequences) are still dispatched, the messages for the port are dropped
+    """
+    def __init__(self, key):
+        self.key = key
+        self.name = None
+        self.droppedCount = 0
+
+    def send_message(self, message):
+        if isinstance(message, RouteAction):
+            message.dispatch(self)
+        else:
+            self.droppedCount += 1
+
+
+class ManagedPort(object):
+    """State of one configured port: the open rtmidi port (or output sender) and its reconnection backoff"""
+    def __init__(self, key, type_):
+        self.key = key
+        self.type_ = type_
+        self.port = None
+        self.name = None
+        self.failures = 0
+        self.retryAt = 0.0
+        self.state = OutputState() if type_ == "output" else None
 
+
+def parse_network_address(name):
+    """(host, port) of a network port name, udp://host:port"""
+    host, _, port = name[len(NETWORK_SCHEME):].rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError("Invalid network port " + repr(name))
+    return host.strip("[]"), int(port)
+
+# Open network ports by name, for the stats
+NETWORK_PORTS = weakref.WeakValueDictionary()
+
+def network_stats():
+    return dict((name, port.stats()) for name, port in list(NETWORK_PORTS.items()))
+
+
+class NetworkMidiOut(object):
+    """
+    Output port sending the messages to another instance over UDP, in place of an rtmidi port.
+    Messages are batched into one datagram until flush() (called by the output sender once its
+    queue is empty) or until the datagram is full. Each datagram carries a sequence number, for
+    the receiver to detect losses, the time of each message on the sender clock, and a session
+    drawn at random when the port is opened, which tells the receiver that the sender restarted.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.address = parse_network_address(name)
+        self._socket = socket.socket(socket.AF_INET6 if ":" in self.address[0] else socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.connect(self.address)
+        self._batch = bytearray()
+        self._count = 0
+        self._firstAt = 0.0
+        self._session = struct.unpack("!I", os.urandom(4))[0]
+        self._sequence = 0
+        self.datagramCount = 0
+        self.messageCount = 0
+        self.errorCount = 0
+        self.oversizedCount = 0
+        self.maxBatch = 0
+        NETWORK_PORTS[name] = self
+
+    def send_message(self, message):
+        if len(message) > NETWORK_MAX_MESSAGE:
+            self.oversizedCount += 1
+            log.warning("Message of %d bytes too long for network port %s, dropped", len(message), self.name)
+            return
+        now = time.perf_counter()
+        size = NETWORK_MESSAGE.size + len(message)
+        if self._count and NETWORK_HEADER.size + len(self._batch) + size > NETWORK_MAX_DATAGRAM:
+            self.flush()
+        if not self._count:
+            self._firstAt = now
+        self._batch += NETWORK_MESSAGE.pack(now - self._firstAt, len(message))
+        self._batch += bytes(message)
+        self._count += 1
+
+    def flush(self):
+        if not self._count:
+            return
+        datagram = NETWORK_HEADER.pack(NETWORK_MAGIC, self._session, self._sequence, self._firstAt, self._count) + self._batch
+        self._sequence += 1
+        self.messageCount += self._count
+        self.maxBatch = max(self.maxBatch, self._count)
+        self._batch = bytearray()
+        self._count = 0
         try:
-            self.midiout_audioItf, self.port_name_audioItf        = open_midiport(MIDI_BUS_CONFIGURATION_AUDIO_INTERFACE_OUT, type_ = "output", interactive=False)
-            self.midiport_audioItf_available = True
-        except (ValueError):
-            log.info("Output Audio interface MIDI port unavailable")
-
-        if self.midiport_guitarWing_available:
-            self.midiin_guitarWing.set_callback(MidiInputHandler_guitarWing(self.midiin_guitarWing, self.midiout_abletonOut))
-            log.info(" *** Guitar Wing callback is attached")
+            self._socket.send(datagram)
+            self.datagramCount += 1
+        except OSError as e:
+            # e.g. nobody listening yet on the other side: the messages are lost, as on an unplugged cable
+            self.errorCount += 1
+            log.debug("Unable to send a datagram to %s: %s", self.name, e)
+
+    def stats(self):
+        return {
+            "datagrams" : self.datagramCount,
+            "messages"  : self.messageCount,
+            "max_batch" : self.maxBatch,
+            "errors"    : self.errorCount,
+            "oversized" : self.oversizedCount,
+        }
+
+    def close_port(self):
+        self.flush()
+        self._socket.close()
+
+
+class NetworkSession(object):
+    """
+    Sequence numbers and clock of one sender seen by a NetworkMidiIn: several senders (e.g. the
+    workers of a --sharded instance) can send to the same port, each with its own session
+    """
+    def __init__(self, session, sequence, now):
+        self.session = session
+        self.expected = sequence        # Next sequence number
+        self.missing = set()            # Skipped sequence numbers, within NETWORK_REORDER_WINDOW
+        self.windowStart = None
+        self.windowMin = None
+        self.previousMin = None
+        self.lastSentAt = None
+        self.lastSeen = now
+
+    def transit_offset(self, transit, now):
+        """Shortest transit time (sender clock to receiver clock) over the current and previous windows"""
+        if self.windowStart is None or now - self.windowStart > NETWORK_CLOCK_WINDOW:
+            self.previousMin, self.windowMin, self.windowStart = self.windowMin, transit, now
         else:
-            log.info(" ###### Unable to attach the Guitar Wing callback, send a MIDI reinit command once the Guitar Wing is connected")
+            self.windowMin = min(self.windowMin, transit)
+        return self.windowMin if self.previousMin is None else min(self.windowMin, self.previousMin)
+
 
-        if self.midiport_abletonInGtr_available and self.midiport_audioItf_available:
-            self.midiin_abletonInGtr.set_callback(MidiInputHandler_abletonGtr(self.midiin_abletonInGtr, self.midiout_audioItf))
-            log.info(" *** Guitar Amp control callback is attached")
+class NetworkMidiIn(object):
+    """
+    Input port receiving the messages of a NetworkMidiOut, in place of an rtmidi port: the handler
+    attached with set_callback routes them through its own tables, from the receiving thread.
+    Messages are played out with the timing they had on the sender, jitterBuffer seconds after the
+    shortest transit time seen (over the last NETWORK_CLOCK_WINDOW seconds, which also absorbs the
+    offset and drift between the clocks of both hosts); a message arriving later than that is
+    delivered at once and counted late. Sequence numbers and clocks are tracked per sender session:
+    gaps are counted as lost datagrams, until the missing one arrives reordered; a datagram seen
+    already, or older than NETWORK_REORDER_WINDOW, is dropped as a duplicate.
+    """
+    def __init__(self, name, jitterBuffer=NETWORK_JITTER_BUFFER):
+        self.name = name
+        self.address = parse_network_address(name)
+        self.jitterBuffer = jitterBuffer
+        self._socket = socket.socket(socket.AF_INET6 if ":" in self.address[0] else socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(self.address)
+        self._callback = None
+        self._data = None
+        self._heap = []
+        self._counter = 0
+        self._sessions = {}             # Sender session -> NetworkSession
+        self._stopping = False
+        self.datagramCount = 0
+        self.messageCount = 0
+        self.lostCount = 0
+        self.reorderedCount = 0
+        self.duplicateCount = 0
+        self.lateCount = 0
+        self.invalidCount = 0
+        self.lateness = Histogram()
+        self._thread = threading.Thread(target=self._run, name="midi-in " + name)
+        self._thread.daemon = True
+        self._thread.start()
+        NETWORK_PORTS[name] = self
+
+    def set_callback(self, callback, data=None):
+        self._data = data
+        self._callback = callback
+
+    def cancel_callback(self):
+        self._callback = None
+
+    def session(self, session, sequence, now):
+        """NetworkSession of a sender, new ones expecting the sequence number of their first datagram"""
+        state = self._sessions.get(session)
+        if state is None:
+            # A new sender, or one which restarted: its previous session goes silent and is forgotten
+            for key in [key for key, other in self._sessions.items() if now - other.lastSeen > NETWORK_SESSION_TIMEOUT]:
+                del self._sessions[key]
+            log.info("Network port %s: new sender session %08x", self.name, session)
+            state = self._sessions[session] = NetworkSession(session, sequence, now)
+        state.lastSeen = now
+        return state
+
+    def receive(self, datagram, now):
+        """Check the sequence number of a datagram and schedule its messages"""
+        if len(datagram) < NETWORK_HEADER.size or datagram[:4] != NETWORK_MAGIC:
+            self.invalidCount += 1
+            return
+        _, session, sequence, sentAt, count = NETWORK_HEADER.unpack_from(datagram)
+        state = self.session(session, sequence, now)
+        if sequence >= state.expected:
+            if sequence > state.expected:
+                self.lostCount += sequence - state.expected
+                state.missing.update(range(max(state.expected, sequence - NETWORK_REORDER_WINDOW), sequence))
+            state.expected = sequence + 1
+            if len(state.missing) > NETWORK_REORDER_WINDOW:
+                state.missing = set(missing for missing in state.missing if missing >= sequence - NETWORK_REORDER_WINDOW)
+        elif sequence in state.missing:
+            # Counted as lost when the next one came first
+            state.missing.discard(sequence)
+            self.lostCount -= 1
+            self.reorderedCount += 1
         else:
-            log.info(" ###### Unable to attach the Guitar Amp control callback, send a MIDI reinit command once the Audio interface is connected")
+            self.duplicateCount += 1
+            return
+        self.datagramCount += 1
+
+        offset = state.transit_offset(now - sentAt, now)
+        position = NETWORK_HEADER.size
+        for _ in range(count):
+            if position + NETWORK_MESSAGE.size > len(datagram):
+                self.invalidCount += 1
+                return
+            delay, length = NETWORK_MESSAGE.unpack_from(datagram, position)
+            position += NETWORK_MESSAGE.size
+            message = list(datagram[position:position + length])
+            position += length
+            # Like a MIDI input, only let valid messages reach the tables
+            if not message or message[0] < 0x80 or (message[0] != 0xF0 and max(message[1:] or [0]) > 127):
+                self.invalidCount += 1
+                continue
+            self._counter += 1
+            heapq.heappush(self._heap, (sentAt + delay + offset + self.jitterBuffer, self._counter, sentAt + delay, message, state))
+
+    def deliver(self, now):
+        """Call the handler with the messages due, return the seconds until the next one"""
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            due, _, sentAt, message, state = heapq.heappop(heap)
+            lateness = now - due
+            self.lateness.record(lateness)
+            if lateness > self.jitterBuffer:
+                self.lateCount += 1
+            deltatime = 0.0 if state.lastSentAt is None else max(sentAt - state.lastSentAt, 0.0)
+            state.lastSentAt = sentAt
+            self.messageCount += 1
+            callback = self._callback
+            if callback is not None:
+                try:
+                    callback((message, deltatime), self._data)
+                except Exception:
+                    log.exception("MIDI handler failed on " + self.name)
+        return heap[0][0] - now if heap else None
+
+    def _run(self):
+        realtime.enter_thread()
+        clock = time.perf_counter
+        wait = None
+        while not self._stopping:
+            try:
+                self._socket.settimeout(NETWORK_POLL_INTERVAL if wait is None else min(max(wait, 0.0), NETWORK_POLL_INTERVAL))
+                datagram = self._socket.recv(65536)
+                self.receive(datagram, clock())
+            except (socket.timeout, BlockingIOError):
+                pass
+            except OSError:
+                if not self._stopping:
+                    log.exception("Unable to receive from network port " + self.name)
+                return
+            wait = self.deliver(clock())
+
+    def stats(self):
+        return {
+            "datagrams"  : self.datagramCount,
+            "messages"   : self.messageCount,
+            "lost"       : self.lostCount,
+            "reordered"  : self.reorderedCount,
+            "duplicates" : self.duplicateCount,
+            "late"       : self.lateCount,
+            "invalid"    : self.invalidCount,
+            "pending"    : len(self._heap),
+            "lateness"   : self.lateness.snapshot(),
+        }
+
+    def close_port(self):
+        self._stopping = True
+        self._callback = None
+        self._socket.close()
+        self._thread.join(NETWORK_POLL_INTERVAL * 2)
+
+
+class MidiPortManager(object):
+    """
+    Opens the configured ports and attaches their handlers, then keeps them connected.
+    The port list is enumerated once per check and cached, and a background thread watches it:
+    ports which disappear are closed with their handlers detached, and ports which (re)appear are
+    opened and get their handlers attached again, without anyone sending the reinit note.
+    The list is checked every PORT_WATCH_INTERVAL seconds while a port is missing, backing off to
+    PORT_WATCH_MAX_INTERVAL once everything is connected; a port which fails to open is retried
+    with an exponential backoff. Input ports are wrapped by inputWrapper(port, name) if given.
+    Network ports (udp://host:port names) are always available.
+    """
+    def __init__(self, mapping, interval=PORT_WATCH_INTERVAL, maxInterval=PORT_WATCH_MAX_INTERVAL, inputWrapper=None):
+        self.mapping = mapping
+        self.inputWrapper = inputWrapper
+        self.interval = interval
+        self.maxInterval = maxInterval
+        self.ports = {}
+        self.routes = []
+        self.handlers = {}
+        self.attachedOnce = set()
+        self.available = {"input": [], "output": []}
+        self._probes = {"input": rtmidi.MidiIn(), "output": rtmidi.MidiOut()}
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_route(self, label, inputKey, outputKey, factory):
+        """
+        Attach factory(portIn, portOut) to the input port once it is open. While the output port (if
+        any) is closed, portOut is a MissingOutput: fan-out destinations and commands still work
+        """
+        self.routes.append((label, inputKey, outputKey, factory))
+        self.ports.setdefault(inputKey, ManagedPort(inputKey, "input"))
+        if outputKey is not None:
+            self.ports.setdefault(outputKey, ManagedPort(outputKey, "output"))
+
+    def scan(self):
+        """Enumerate the ports once, and return True if the list changed since the previous scan"""
+        available = dict((type_, probe.get_ports()) for type_, probe in self._probes.items())
+        changed = available != self.available
+        self.available = available
+        return changed
+
+    def find_port(self, managed):
+        wanted = self.mapping.ports.get(managed.key)
+        if wanted is None:
+            return None, None
+        if wanted.startswith(NETWORK_SCHEME):
+            return wanted, wanted
+        for index, name in enumerate(self.available[managed.type_]):
+            if wanted in name:
+                return index, name
+        return None, None
+
+    def open_port(self, managed, index, name):
+        network = name.startswith(NETWORK_SCHEME)
+        if managed.type_ == "input":
+            if network:
+                port = NetworkMidiIn(name)
+            else:
+                port = rtmidi.MidiIn()
+                port.open_port(index)
+            if self.inputWrapper is not None:
+                port = self.inputWrapper(port, name)
+        else:
+            if network:
+                port = NetworkMidiOut(name)
+            else:
+                port = rtmidi.MidiOut()
+                port.open_port(index)
+            port = MidiOutputSender(port, name, state=managed.state, key=managed.key)
+            self.mapping.register_output(managed.key, port)
+        managed.port = port
+        managed.name = name
+        managed.failures = 0
+        log.info("MIDI port %s opened (%s)", name, managed.key)
+        if managed.state is not None:
+            # The device may have been switched off or reset while it was disconnected
+            port.resync()
+
+    def close_port(self, managed):
+        if managed.port is None:
+            return
+        try:
+            managed.port.close_port()
+        except Exception:
+            log.exception("Unable to close MIDI port " + str(managed.name))
+        if managed.type_ == "output":
+            self.mapping.unregister_output(managed.key, managed.port)
+        log.info("MIDI port %s closed (%s)", managed.name, managed.key)
+        managed.port = None
+        managed.name = None
+
+    def update(self):
+        """
+        Rescan the ports, close the ones which disappeared, then for each route in turn, open its new
+        ports and (re)attach its handler: the routes added first (the critical ones) are up before
+        the ports of the next ones are even opened
+        """
+        with self._lock:
+            changed = self.scan()
+            now = time.perf_counter()
+            reopened = set()
+            for managed in self.ports.values():
+                if managed.port is not None and self.find_port(managed)[1] != managed.name:
+                    log.info("MIDI port %s (%s) disappeared", managed.name, managed.key)
+                    self.close_port(managed)
+                    reopened.add(managed.key)
+
+            for label, inputKey, outputKey, factory in self.routes:
+                for key in (inputKey, outputKey):
+                    if key is not None and self.ports[key].port is None and self.reopen(self.ports[key], now):
+                        reopened.add(key)
+                if inputKey in reopened or outputKey in reopened or inputKey not in self.handlers:
+                    self.attach(label, inputKey, outputKey, factory)
+
+            # Fan-out destinations come last, the handlers reach them through the mapping
+            for key in self.mapping.fanout_outputs():
+                managed = self.ports.setdefault(key, ManagedPort(key, "output"))
+                if managed.port is None and self.reopen(managed, now):
+                    reopened.add(key)
+            return changed or bool(reopened)
+
+    def reopen(self, managed, now):
+        """Open a closed port if it is available and not waiting for a retry, return True if it was opened"""
+        index, name = self.find_port(managed)
+        if index is None or now < managed.retryAt:
+            return False
+        try:
+            self.open_port(managed, index, name)
+            return True
+        except (rtmidi.RtMidiError, ValueError, OSError) as e:
+            managed.failures += 1
+            managed.retryAt = now + min(self.interval * 2 ** managed.failures, PORT_RETRY_MAX_INTERVAL)
+            log.error("Unable to open MIDI port %s: %s", name, e)
+            return False
+
+    def attach(self, label, inputKey, outputKey, factory):
+        portIn = self.ports[inputKey].port
+        portOut = self.ports[outputKey].port if outputKey is not None else None
+        handler = self.handlers.pop(inputKey, None)
+        if handler is not None and hasattr(handler, "close"):
+            handler.close()
+        if portIn is None:
+            if handler is not None:
+                log.info(" ###### %s callback is detached, waiting for its ports to come back", label)
+            return
+        if outputKey is not None and portOut is None:
+            portOut = MissingOutput(outputKey)
+            log.info(" ###### %s output port is missing, only its fan-out and commands are routed", label)
+        handler = factory(portIn, portOut)
+        portIn.set_callback(handler)
+        self.handlers[inputKey] = handler
+        log.info(" *** %s callback is attached", label)
+        if inputKey not in self.attachedOnce:
+            self.attachedOnce.add(inputKey)
+            startup.mark(label + " attached")
+
+    def resync(self):
+        """Push the cached state of every open output port"""
+        with self._lock:
+            for managed in self.ports.values():
+                if managed.state is not None and managed.port is not None:
+                    managed.port.resync()
+
+    def missing(self):
+        return [key for key, managed in self.ports.items() if managed.port is None]
+
+    def reinitialize(self):
+        """Close every port and reopen them from scratch, e.g. when the reinit note is received"""
+        with self._lock:
+            for inputKey in list(self.handlers):
+                handler = self.handlers.pop(inputKey)
+                if hasattr(handler, "close"):
+                    handler.close()
+            for managed in self.ports.values():
+                self.close_port(managed)
+                managed.failures = 0
+                managed.retryAt = 0.0
+            self.update()
+        for key in self.missing():
+            log.info("MIDI port %s (%s) unavailable", self.mapping.ports[key], key)
+
+    def start(self):
+        self.reinitialize()
+        self._thread = threading.Thread(target=self._watch, name="port-manager")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def next_interval(self, interval, changed):
+        """Check again soon while ports are missing or changing, back off while everything is connected"""
+        if changed or self.missing():
+            return self.interval
+        return min(interval * 2, self.maxInterval)
+
+    def _watch(self):
+        interval = self.interval
+        while not self._stop.wait(interval):
+            try:
+                changed = self.update()
+            except Exception:
+                log.exception("MIDI port check failed")
+                changed = True
+            interval = self.next_interval(interval, changed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "available" : self.available,
+                "ports"     : dict((key, {"name": managed.name, "open": managed.port is not None, "failures": managed.failures})
+                                   for key, managed in self.ports.items()),
+                "attached"  : sorted(self.handlers),
+            }
 
     def close(self):
-        if hasattr(self, "midiin_guitarWing"):
-            self.midiin_guitarWing.close_port()
-            del self.midiin_guitarWing
-        if hasattr(self, "midiout_audioItf"):
-            self.midiout_audioItf.close_port()
-            del self.midiout_audioItf
-        if hasattr(self, "midiout_abletonOut"):
-            self.midiout_abletonOut.close_port()
-            del self.midiout_abletonOut
-        if hasattr(self, "midiin_abletonInGtr"):
-            self.midiin_abletonInGtr.close_port()
-            del self.midiin_abletonInGtr
-
-
-class MidiInputHandler_guitarWing(object):
-    def __init__(self, portIn, portOut):
+        self._stop.set()
+        with self._lock:
+            for inputKey in list(self.handlers):
+                handler = self.handlers.pop(inputKey)
+                if hasattr(handler, "close"):
+                    handler.close()
+            for managed in self.ports.values():
+                self.close_port(managed)
+
+
+class RealtimeMidiInput(object):
+    """
+    rtmidi input port of the realtime mode: the rtmidi thread calling the handler gets the realtime
+    settings on its first event, which costs one more call per event
+    """
+    def __init__(self, port, name):
+        self.port = port
+        self.name = name
+        self._callback = None
+        self._entered = False
+
+    def _receive(self, event, data=None):
+        if not self._entered:
+            self._entered = True
+            realtime.enter_thread()
+        self._callback(event, data)
+
+    def set_callback(self, callback, data=None):
+        self._callback = callback
+        self.port.set_callback(self._receive, data)
+
+    def cancel_callback(self):
+        self.port.cancel_callback()
+
+    def close_port(self):
+        self.port.cancel_callback()
+        self.port.close_port()
+
+
+class MidiInputHandler(object):
+    """
+    Handler of an input port routed by the mapping: the messages of its ROUTES table for each event
+    are sent to the output port
+    """
+    ROUTES = None
+
+    def __init__(self, portIn, portOut, mapping=None):
         self.portIn = portIn
         self.portOut = portOut
         self._wallclock = time.time()
-        
-        #Pitches for messages coming from the Guitar Wing
-        self.PITCH_WING_BIG_ROUND_BUTTON_1 = 36
-        self.PITCH_WING_BIG_ROUND_BUTTON_2 = 37
-        self.PITCH_WING_BIG_ROUND_BUTTON_3 = 38
-        self.PITCH_WING_BIG_ROUND_BUTTON_4 = 39
-        self.PITCH_WING_ARROW_NEXT         = 40
-        self.PITCH_WING_ARROW_PREVIOUS     = 41
-        self.PITCH_WING_SMALL_RECTANGLE_1  = 42
-        self.PITCH_WING_SMALL_RECTANGLE_2  = 43
-        self.PITCH_WING_SMALL_RECTANGLE_3  = 44
-        self.PITCH_WING_SMALL_RECTANGLE_4  = 45
-        self.PITCH_WING_SMALL_SWITCH_1     = 46
-        self.PITCH_WING_SMALL_SWITCH_2     = 47
-        self.PITCH_WING_SMALL_SWITCH_3     = 48
-        self.PITCH_WING_SMALL_SWITCH_4     = 49
-        self.PITCH_TOGGLE                  = 4
-        self.CC_SMALL_FADER_1              = 1
-        self.CC_SMALL_FADER_2              = 2
-        self.CC_BIG_FADER                  = 3
+        self._send = self.portOut.send_message
+        self.metrics = metrics.handler(self.ROUTES)
+        self.journalSource = JOURNAL_SOURCES.index(self.ROUTES)
+        (mapping or MidiMapping()).register(self)
+
+    def set_routes(self, routes):
+        self._lookup = routes.lookup
 
     def __call__(self, event, data=None):
+        start = time.perf_counter()
         event, deltatime = event
+        journal.record(JOURNAL_IN, self.journalSource, event, deltatime, start)
+        messages = self._lookup(event)
+        sendStart = time.perf_counter()
+        for message in messages:
+            self._send(message)
+        self.metrics.record(event, deltatime, start, sendStart)
 
-        if event[0] < 0xF0:
-            channel = (event[0] & 0xF)
-            status = event[0] & 0xF0
-        else:
-            status = event[0]
-            channel = None
-
-        data1 = data2 = None
-        num_bytes = len(event)
-        if num_bytes >= 2:
-            data1 = event[1]
-        if num_bytes >= 3:
-            data2 = event[2]
-
-        if status == STATUS_NOTE_ON:
-            if   data1 == self.PITCH_WING_BIG_ROUND_BUTTON_1:
-                self.sendMidiOut_On_GuitarWing_BigRoundButton1()
-            elif data1 == self.PITCH_WING_BIG_ROUND_BUTTON_2: 
-                self.sendMidiOut_On_GuitarWing_BigRoundButton2()
-            elif data1 == self.PITCH_WING_BIG_ROUND_BUTTON_3: 
-                self.sendMidiOut_On_GuitarWing_BigRoundButton3()
-            elif data1 == self.PITCH_WING_BIG_ROUND_BUTTON_4: 
-                self.sendMidiOut_On_GuitarWing_BigRoundButton4()
-            elif data1 == self.PITCH_WING_SMALL_RECTANGLE_1:  
-                self.sendMidiOut_On_GuitarWing_SmallRectangle1()
-            elif data1 == self.PITCH_WING_SMALL_RECTANGLE_2:  
-                self.sendMidiOut_On_GuitarWing_SmallRectangle2()
-            elif data1 == self.PITCH_WING_SMALL_RECTANGLE_3:  
-                self.sendMidiOut_On_GuitarWing_SmallRectangle3()
-            elif data1 == self.PITCH_WING_SMALL_RECTANGLE_4:  
-                self.sendMidiOut_On_GuitarWing_SmallRectangle4()
-            elif data1 == self.PITCH_TOGGLE:                  
-                self.sendMidiOut_On_GuitarWing_Toggle()
-
-        elif status == STATUS_NOTE_OFF:
-            if   data1 == self.PITCH_WING_BIG_ROUND_BUTTON_1: 
-                self.sendMidiOut_Off_GuitarWing_BigRoundButton1()
-            elif data1 == self.PITCH_WING_BIG_ROUND_BUTTON_2: 
-                self.sendMidiOut_Off_GuitarWing_BigRoundButton2()
-            elif data1 == self.PITCH_WING_BIG_ROUND_BUTTON_3: 
-                self.sendMidiOut_Off_GuitarWing_BigRoundButton3()
-            elif data1 == self.PITCH_WING_BIG_ROUND_BUTTON_4: 
-                self.sendMidiOut_Off_GuitarWing_BigRoundButton4()
-            elif data1 == self.PITCH_TOGGLE:                  
-                self.sendMidiOut_Off_GuitarWing_Toggle()
-
-        elif status == STATUS_CC:
-            if data1 == self.CC_BIG_FADER:
-                self.sendMidiOut_CC_BigFader(data2)
-
-    def sendMidiOut_On_GuitarWing_BigRoundButton1(self):
-        self.sendControllerChange(4, 13, 127)
-
-    def sendMidiOut_On_GuitarWing_BigRoundButton2(self):
-        self.sendControllerChange(0, 16, 127)
-        self.sendNoteOn(0, 44, 127)
-
-    def sendMidiOut_On_GuitarWing_BigRoundButton3(self):
-        self.sendControllerChange(0, 16, 110)
-        self.sendNoteOn(0, 44, 127)
-
-    def sendMidiOut_On_GuitarWing_BigRoundButton4(self):
-        self.sendControllerChange(0, 52, 76)
-
-    def sendMidiOut_On_GuitarWing_SmallRectangle1(self):
-        self.sendControllerChange(0, 16, 0)
-
-    def sendMidiOut_On_GuitarWing_SmallRectangle2(self):
-        self.sendControllerChange(0, 16, 45)
-
-    def sendMidiOut_On_GuitarWing_SmallRectangle3(self):
-        self.sendControllerChange(0, 16, 64)
-
-    def sendMidiOut_On_GuitarWing_SmallRectangle4(self):
-        self.sendControllerChange(0, 16, 110)
-
-    def sendMidiOut_On_GuitarWing_Toggle(self):
+    def close(self):
         pass
 
-    def sendMidiOut_Off_GuitarWing_BigRoundButton1(self):
-        self.sendControllerChange(4, 13, 0)
 
-    def sendMidiOut_Off_GuitarWing_BigRoundButton2(self):
-        self.sendNoteOn(0, 44, 127)
+class MidiInputHandler_guitarWing(MidiInputHandler):
+    ROUTES = "guitar_wing"
 
-    def sendMidiOut_Off_GuitarWing_BigRoundButton3(self):
-        self.sendNoteOn(0, 44, 127)
 
-    def sendMidiOut_Off_GuitarWing_BigRoundButton4(self):
-        self.sendControllerChange(0, 52, 0)
+class MidiInputHandler_abletonVoiceFx(MidiInputHandler):
+    # From VoiceFX, back to Ableton
+    ROUTES = "voice_fx"
 
-    def sendMidiOut_Off_GuitarWing_SmallRectangle1(self):
-        pass
 
-    def sendMidiOut_Off_GuitarWing_SmallRectangle2(self):
-        pass
+class MidiInputHandler_abletonGtr(MidiInputHandler):
+    # From Gtr, to the Kemper. The amp only switches when the requested preset differs from the
+    # current one, as the output state of the audio interface port drops repeated program changes
+    ROUTES = "gtr"
 
-    def sendMidiOut_Off_GuitarWing_SmallRectangle3(self):
-        pass
 
-    def sendMidiOut_Off_GuitarWing_SmallRectangle4(self):
-        pass
+def add_routes(portManager, mapping, reinitScheduler, strobotSupervisor, resync=None, inputKeys=None):
+    """Declare the routes of the program on a port manager, or only those of the given input ports"""
+    # The macro steps go to the senders open when they are due
+    macros.outputs = mapping.senders
+    routes = [
+        # The emergency control and VoiceFX callbacks should always be available - if not, the computer is not configured properly.
+        # They come first, so that they are opened and attached before the optional devices
+        ("Emergency control", "emergency_control", None,
+         lambda portIn, portOut: MidiInputHandler_emergencyControl_MIDI(portIn, reinitScheduler, strobotSupervisor, resync or reinitScheduler.request_resync)),
+        ("Ableton VoiceFX", "ableton_in_voice_fx", "ableton_out",
+         lambda portIn, portOut: MidiInputHandler_abletonVoiceFx(portIn, portOut, mapping)),
+        ("Guitar Wing", "guitar_wing", "ableton_out",
+         lambda portIn, portOut: MidiInputHandler_guitarWing(portIn, portOut, mapping)),
+        ("Guitar Amp control", "ableton_in_gtr", "audio_interface_out",
+         lambda portIn, portOut: MidiInputHandler_abletonGtr(portIn, portOut, mapping)),
+    ]
+    for label, inputKey, outputKey, factory in routes:
+        if inputKeys is None or inputKey in inputKeys:
+            portManager.add_route(label, inputKey, outputKey, factory)
 
-    def sendMidiOut_Off_GuitarWing_Toggle(self):
-        pass
 
-    def sendMidiOut_CC_BigFader(self, value):
-        self.sendControllerChange(0, 56, int(value * 127.0/100.0))
+def parse_message(message):
+    """Bytes of a MIDI message given as a list of integers, checked"""
+    if not isinstance(message, list) or not message or not all(isinstance(byte, int) for byte in message):
+        raise ValueError("A message is a non-empty list of bytes")
+    if message[0] < 0x80 or message[0] > 0xFF or any(byte < 0 or byte > 127 for byte in message[1:]):
+        raise ValueError("Invalid MIDI message %r" % (message,))
+    return cached_message(message)
 
 
+def control_commands(portManager, mapping, reinitScheduler, strobotSupervisor, call=None):
+    """
+    Commands of the ControlServer. Injected input messages are passed to the handler through
+    call(handler, event) if given, e.g. to run it in the event loop of the asyncio runtime
+    """
+    def health(request):
+        outputs = list(metrics.outputs.values())
+        return {
+            "uptime_s" : time.time() - metrics.startedAt,
+            "attached" : sorted(portManager.handlers),
+            "missing"  : sorted(portManager.missing()),
+            "events"   : sum(handler.callback.count for handler in list(metrics.handlers.values())),
+            "sent"     : sum(sender.sentCount for sender in outputs),
+            "dropped"  : sum(sender.droppedCount for sender in outputs),
+        }
+
+    def ports(request):
+        stats = portManager.stats()
+        stats["handlers"] = dict((key, {"class": type(handler).__name__, "table": getattr(handler, "ROUTES", None),
+                                        "events": handler.metrics.callback.count})
+                                 for key, handler in list(portManager.handlers.items()))
+        stats["disabled"] = mapping.disabled_rules()
+        return stats
+
+    def reinit(request):
+        reinitScheduler.request()
+        return {"requested": True}
+
+    def resync(request):
+        portManager.resync()
+        return {"outputs": sorted(mapping.senders)}
+
+    def restart_strobot(request):
+        # False when debounced, as for the MIDI trigger
+        return {"requested": strobotSupervisor.request_restart()}
+
+    def enable(request):
+        return {"disabled": mapping.set_enabled(request["table"], request.get("rule"), True)}
+
+    def disable(request):
+        return {"disabled": mapping.set_enabled(request["table"], request.get("rule"), False)}
+
+    def inject(request):
+        """Route a message as if received on an input port, or send it to an output port"""
+        message = parse_message(request["message"])
+        if "input" in request:
+            handler = portManager.handlers.get(request["input"])
+            if handler is None:
+                raise ValueError("No handler attached to input %r" % (request["input"],))
+            event = (list(message), INJECTED_DELTATIME)
+            if call is not None:
+                call(handler, event)
+            else:
+                handler(event)
+            return {"input": request["input"], "message": list(message)}
+        sender = mapping.senders.get(request.get("output"))
+        if sender is None:
+            raise ValueError("An injected message needs an attached \"input\" or an open \"output\"")
+        sender.send_message(message)
+        return {"output": request["output"], "message": list(message)}
+
+    commands = {
+        "stats"           : lambda request: metrics.snapshot(),
+        "health"          : health,
+        "ports"           : ports,
+        "reinit"          : reinit,
+        "resync"          : resync,
+        "restart_strobot" : restart_strobot,
+        "enable"          : enable,
+        "disable"         : disable,
+        "inject"          : inject,
+    }
+    commands["help"] = lambda request: sorted(commands)
+    return commands
+
+
+class ShardControl(object):
+    """
+    Shared-memory channel between the parent and one shard worker process. The worker publishes
+    its stats, its heartbeat and for how long its input callback has been running (a callback
+    stuck in its handler does not stop the heartbeat of the main loop), and counts the
+    reinit/resync requests it received from MIDI; the
+    parent counts the reinit/resync commands and the stop order it sends. Each slot has a single
+    writer, and each side wakes the other up through a semaphore (unlike an Event, releasing it
+    never blocks on a waiter which has been killed).
+    """
+    HEARTBEAT, EVENTS, CALLBACK_MEAN_US, CALLBACK_MAX_US, JITTER_MAX_US, SENT, DROPPED, CALLBACK_BUSY_S, \
+        REQUESTED_REINITS, REQUESTED_RESYNCS, REINITS, RESYNCS, STOP = range(13)
+
+    def __init__(self, context, parentWake):
+        self.shared = context.Array('d', 13, lock=False)
+        self.wake = context.Semaphore(0)
+        self.parentWake = parentWake
+
+    # Worker side, duck-typing the ReinitScheduler for the emergency handler
+    def request(self):
+        """Forward a reinit request to the parent, which sends it to every shard"""
+        self.shared[self.REQUESTED_REINITS] += 1
+        self.parentWake.release()
+
+    def resync(self):
+        self.shared[self.REQUESTED_RESYNCS] += 1
+        self.parentWake.release()
+
+    def publish(self, registry, inputs=()):
+        now = time.perf_counter()
+        self.shared[self.CALLBACK_BUSY_S] = max([now - port.busySince for port in list(inputs) if port.busySince is not None] or [0.0])
+        handlers = list(registry.handlers.values())
+        outputs = list(registry.outputs.values())
+        callbacks = sum(handler.callback.count for handler in handlers)
+        self.shared[self.EVENTS] = callbacks
+        self.shared[self.CALLBACK_MEAN_US] = sum(handler.callback.total for handler in handlers) / callbacks * 1e6 if callbacks else 0.0
+        self.shared[self.CALLBACK_MAX_US] = max([handler.callback.max for handler in handlers] or [0.0]) * 1e6
+        self.shared[self.JITTER_MAX_US] = max([handler.jitter.max for handler in handlers] or [0.0]) * 1e6
+        self.shared[self.SENT] = sum(sender.sentCount for sender in outputs)
+        self.shared[self.DROPPED] = sum(sender.droppedCount for sender in outputs)
+        self.shared[self.HEARTBEAT] = time.time()
+
+    # Parent side
+    def send(self, slot):
+        self.shared[slot] += 1
+        self.wake.release()
+
+    def stats(self):
+        return {
+            "heartbeat_age_s" : time.time() - self.shared[self.HEARTBEAT] if self.shared[self.HEARTBEAT] else None,
+            "events"          : int(self.shared[self.EVENTS]),
+            "callback_mean_us": self.shared[self.CALLBACK_MEAN_US],
+            "callback_max_us" : self.shared[self.CALLBACK_MAX_US],
+            "jitter_max_us"   : self.shared[self.JITTER_MAX_US],
+            "sent"            : int(self.shared[self.SENT]),
+            "dropped"         : int(self.shared[self.DROPPED]),
+            "callback_busy_s" : self.shared[self.CALLBACK_BUSY_S],
+        }
+
+
+class ShardMidiInput(object):
+    """
+    rtmidi input port of a shard worker: keeps the time at which the running callback started,
+    for the worker to report a callback stuck in its handler, at the price of a wrapper call per event
+    """
+    def __init__(self, port, name):
+        self.port = port
+        self.name = name
+        self._callback = None
+        self.busySince = None
 
-    def sendControllerChange(self, channel, number, value):
-        cc = [STATUS_CC + channel, number, value]
-        self.portOut.send_message(cc)
+    def _receive(self, event, data=None):
+        self.busySince = time.perf_counter()
+        try:
+            self._callback(event, data)
+        finally:
+            self.busySince = None
+
+    def set_callback(self, callback, data=None):
+        self._callback = callback
+        self.port.set_callback(self._receive, data)
+
+    def cancel_callback(self):
+        self.port.cancel_callback()
+
+    def close_port(self):
+        self.port.cancel_callback()
+        self.port.close_port()
+
+
+def run_shard(inputKey, mappingPath, control, journalPath=None):
+    """Worker process: route a single input port, with its own port handles and journal file"""
+    logging.basicConfig(format="%(name)s[" + inputKey + "]: %(levelname)s - %(message)s", level=logging.DEBUG)
+    # Ctrl-C is handled by the parent, which stops its workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if journalPath:
+        journal.open("%s.%s" % (journalPath, inputKey))
+
+    mapping = MidiMapping(mappingPath)
+    mapping.watch()
+    strobotSupervisor = StrobotSupervisor()
+    strobotSupervisor.start()
+    inputs = weakref.WeakSet()
+
+    def wrap_input(port, name):
+        port = ShardMidiInput(port, name)
+        inputs.add(port)
+        return port
+
+    portManager = MidiPortManager(mapping, inputWrapper=wrap_input)
+    add_routes(portManager, mapping, control, strobotSupervisor, control.resync, [inputKey])
+    portManager.start()
+    runner.start()
+    macros.start()
+
+    # A restarted worker only acts on the commands sent after its start
+    reinits, resyncs = control.shared[control.REINITS], control.shared[control.RESYNCS]
+    try:
+        while not control.shared[control.STOP]:
+            control.publish(metrics, inputs)
+            control.wake.acquire(timeout=SHARD_HEARTBEAT_INTERVAL)
+            if control.shared[control.REINITS] != reinits:
+                reinits = control.shared[control.REINITS]
+                portManager.reinitialize()
+            if control.shared[control.RESYNCS] != resyncs:
+                resyncs = control.shared[control.RESYNCS]
+                portManager.resync()
+    finally:
+        macros.close()
+        runner.close()
+        portManager.close()
+        mapping.close()
+        strobotSupervisor.close()
+        journal.close()
 
-    def sendNoteOn(self, channel, pitch, velocity):
-        note_on = [STATUS_NOTE_ON + channel, pitch, velocity]
-        self.portOut.send_message(note_on)
 
-    def sendNoteOff(self, channel, pitch, velocity):
-        note_off = [STATUS_NOTE_OFF + channel, pitch, velocity]
-        self.portOut.send_message(note_off)
+class ShardSupervisor(object):
+    """
+    Runs the routing of each input port in its own worker process, so that a slow or stuck
+    callback on one bus (e.g. the emergency control) cannot delay the others through the GIL.
+    Crashed workers, workers which stop publishing their heartbeat and workers with a callback
+    running for SHARD_CALLBACK_TIMEOUT seconds are restarted. Reinit and resync requests
+    received by any worker are sent to all of them.
+    Each worker opens its own handle on its output port: the routes sharing a port (VoiceFX and
+    the Guitar Wing both send to ableton_out) each have their own output state, CC coalescing
+    and rate limits, which only apply to the messages of their worker. A resync pushes the
+    state of each worker, so together the whole state; but a rate-limited controller fed by two
+    routes can reach up to twice its max_rate.
+    """
+    def __init__(self, mappingPath, inputKeys=SHARD_INPUTS, journalPath=None):
+        # spawn rather than fork: the workers must not inherit the rtmidi and thread state of the parent
+        import multiprocessing
+        self.context = multiprocessing.get_context("spawn")
+        self.mappingPath = mappingPath
+        self.journalPath = journalPath
+        self.wake = self.context.Semaphore(0)
+        self.shards = dict((key, {"control": ShardControl(self.context, self.wake), "process": None,
+                                  "startedAt": 0.0, "restarts": 0, "requests": [0, 0]})
+                           for key in inputKeys)
+        self._stopping = False
+
+    def start_shard(self, key):
+        shard = self.shards[key]
+        shard["control"].shared[ShardControl.HEARTBEAT] = 0.0
+        shard["control"].shared[ShardControl.CALLBACK_BUSY_S] = 0.0
+        shard["process"] = self.context.Process(target=run_shard, name="midi2command " + key,
+                                                args=(key, self.mappingPath, shard["control"], self.journalPath))
+        shard["process"].daemon = True
+        shard["process"].start()
+        shard["startedAt"] = time.time()
+        log.info("Shard %s started (PID = %d)", key, shard["process"].pid)
+
+    def check_shard(self, key):
+        shard = self.shards[key]
+        process = shard["process"]
+        now = time.time()
+        heartbeat = shard["control"].shared[ShardControl.HEARTBEAT]
+        busy = shard["control"].shared[ShardControl.CALLBACK_BUSY_S]
+        if process.exitcode is None and heartbeat and now - heartbeat > SHARD_HEARTBEAT_TIMEOUT:
+            log.error("Shard %s stopped responding, killing it", key)
+            process.kill()
+            process.join(1.0)
+        elif process.exitcode is None and busy > SHARD_CALLBACK_TIMEOUT:
+            log.error("Shard %s callback stuck for %.1fs, killing it", key, busy)
+            process.kill()
+            process.join(1.0)
+        if process.exitcode is not None:
+            if now - shard["startedAt"] < SHARD_RESTART_BACKOFF:
+                return      # Crashed right after starting, give the cause a chance to go away
+            log.error("Shard %s exited with code %s, restarting it", key, process.exitcode)
+            shard["restarts"] += 1
+            self.start_shard(key)
+
+    def forward_requests(self):
+        reinit = resync = False
+        for shard in self.shards.values():
+            shared = shard["control"].shared
+            requests = [shared[ShardControl.REQUESTED_REINITS], shared[ShardControl.REQUESTED_RESYNCS]]
+            reinit = reinit or requests[0] != shard["requests"][0]
+            resync = resync or requests[1] != shard["requests"][1]
+            shard["requests"] = requests
+        for shard in self.shards.values():
+            if reinit:
+                shard["control"].send(ShardControl.REINITS)
+            if resync:
+                shard["control"].send(ShardControl.RESYNCS)
+        if reinit:
+            log.info("Reinitialize the MIDI inputs/outputs of every shard")
+
+    def run(self):
+        for key in self.shards:
+            self.start_shard(key)
+        while not self._stopping:
+            self.wake.acquire(timeout=SHARD_HEARTBEAT_INTERVAL)
+            self.forward_requests()
+            for key in self.shards:
+                self.check_shard(key)
+
+    def stats(self):
+        stats = {}
+        for key, shard in self.shards.items():
+            stats[key] = shard["control"].stats()
+            stats[key]["pid"] = shard["process"].pid if shard["process"] is not None else None
+            stats[key]["restarts"] = shard["restarts"]
+        return stats
 
+    def close(self):
+        self._stopping = True
+        for shard in self.shards.values():
+            shard["control"].send(ShardControl.STOP)
+        for key, shard in self.shards.items():
+            if shard["process"] is not None:
+                shard["process"].join(2.0)
+                if shard["process"].exitcode is None:
+                    log.error("Shard %s did not stop, killing it", key)
+                    shard["process"].kill()
+
+
+def run_sharded(args):
+    """Main loop of the sharded mode: the parent only supervises the workers and publishes their stats"""
+    supervisor = ShardSupervisor(args.mapping, journalPath=args.journal)
+    metrics.register_provider("shards", supervisor.stats)
+    statsServer = StatsServer(args.stats_socket) if args.stats_socket else None
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        log.debug('Shutting down program')
+    finally:
+        supervisor.close()
+        if statsServer is not None:
+            statsServer.close()
 
-class MidiInputHandler_abletonVoiceFx(object):
-    def __init__(self, portIn, portOut):
-        self.portIn = portIn            #VoiceFX
-        self.portOut = portOut          #Back to Ableton
-        self._wallclock = time.time()
-        self.currentAmpPreset = -1
 
-    def __call__(self, event, data=None):
-        event, deltatime = event
-        
-        if event[0] < 0xF0:
-            channel = (event[0] & 0xF)
-            status = event[0] & 0xF0
-        else:
-            status = event[0]
-            channel = None
-
-        data1 = data2 = None
-        num_bytes = len(event)
-        if num_bytes >= 2:
-            data1 = event[1]
-        if num_bytes >= 3:
-            data2 = event[2]
-
-        if status == STATUS_NOTE_ON:
-            if   channel == ABLETON_VOICE_FX_CTRL_CHANNEL:
-                if data1 == 35:
-                    # Special action: disable the RMX Spiral
-                    self.sendControllerChange(0,20,0)
-                else:
-                    self.sendControllerChange(OUTPUT_CHANNEL_ABLETON_VOICEFX, data1, data2)
+class AsyncReinitScheduler(ReinitScheduler):
+    """ReinitScheduler which also wakes up a coroutine of the asyncio runtime"""
+    def __init__(self, loop):
+        import asyncio
+        ReinitScheduler.__init__(self)
+        self.loop = loop
+        self._wakeup = asyncio.Event()
 
-        elif status == STATUS_NOTE_OFF:
-            if channel == ABLETON_VOICE_FX_CTRL_CHANNEL:
-                self.sendControllerChange(OUTPUT_CHANNEL_ABLETON_VOICEFX, data1, 0)
+    def request(self):
+        ReinitScheduler.request(self)
+        self.loop.call_soon_threadsafe(self._wakeup.set)
 
-    def sendControllerChange(self, channel, number, value):
-        cc = [STATUS_CC + channel, number, value]
-        self.portOut.send_message(cc)
+    def request_resync(self):
+        ReinitScheduler.request_resync(self)
+        self.loop.call_soon_threadsafe(self._wakeup.set)
 
-    def close(self):
-        pass
+    async def wait_async(self):
+        """Wait for a reinit or resync request without blocking the loop. Return the number of reinit requests it covers"""
+        await self._wakeup.wait()
+        self._wakeup.clear()
+        return self.wait(0)
 
-class MidiInputHandler_abletonGtr(object):
-    def __init__(self, portIn, portOut):
-        self.portIn = portIn            #Gtr
-        self.portOut = portOut          #To the Kemper
-        self._wallclock = time.time()
-        self.currentAmpPreset = -1
 
-    def __call__(self, event, data=None):
-        event, deltatime = event
-        
-        if event[0] < 0xF0:
-            channel = (event[0] & 0xF)
-            status = event[0] & 0xF0
-        else:
-            status = event[0]
-            channel = None
+class AsyncMidiInput(object):
+    """
+    rtmidi input port feeding the asyncio event loop: the rtmidi thread only hands each event over
+    with call_soon_threadsafe, and the handler attached with set_callback is called from the loop.
+    Every handler thus runs in the same thread, one event at a time, so their state needs no lock.
+    Without a handler, the events can be read with `async for event in port`.
+    """
+    def __init__(self, port, name, loop):
+        self.port = port
+        self.name = name
+        self.loop = loop
+        self._callback = None
+        self._data = None
+        self._queue = None
+        port.set_callback(self._receive)
 
-        data1 = data2 = None
-        num_bytes = len(event)
-        if num_bytes >= 2:
-            data1 = event[1]
-        if num_bytes >= 3:
-            data2 = event[2]
-        
-        if status == STATUS_NOTE_ON:
-            if channel == ABLETON_GTR_CTRL_CHANNEL:
-                if data1 != self.currentAmpPreset:
-                    self.sendProgramChange_audioItf(OUTPUT_CHANNEL_KEMPER_AMP, max(data1 - 1,0))
-                self.currentAmpPreset = data1
+    def _receive(self, event, data=None):
+        self.loop.call_soon_threadsafe(self._dispatch, event)
 
-    def sendProgramChange_audioItf(self, channel, number):
-        pc  = [STATUS_PC + channel, number]
-        self.portOut.send_message(pc)
+    def _dispatch(self, event):
+        if self._callback is not None:
+            try:
+                self._callback(event, self._data)
+            except Exception:
+                log.exception("MIDI handler failed on " + self.name)
+        elif self._queue is not None:
+            self._queue.put_nowait(event)
+
+    def set_callback(self, callback, data=None):
+        self._data = data
+        self._callback = callback
+
+    def cancel_callback(self):
+        self._callback = None
+
+    def __aiter__(self):
+        if self._queue is None:
+            import asyncio
+            self._queue = asyncio.Queue()
+        return self
+
+    async def __anext__(self):
+        return await self._queue.get()
+
+    def close_port(self):
+        self._callback = None
+        self.port.cancel_callback()
+        self.port.close_port()
+
+
+async def watch_ports(portManager):
+    """Port watcher of the asyncio runtime: the checks are scheduled on the loop, the port I/O runs in the executor"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    interval = portManager.interval
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            changed = await loop.run_in_executor(None, portManager.update)
+        except Exception:
+            log.exception("MIDI port check failed")
+            changed = True
+        interval = portManager.next_interval(interval, changed)
 
 
+async def watch_mapping(mapping, interval=MAPPING_WATCH_INTERVAL):
+    """
+    Mapping watcher of the asyncio runtime: the file is compiled in the executor, then the tables
+    are swapped from the loop between two events
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if not mapping.changed():
+                continue
+            log.info("Mapping file changed, reloading it")
+            compiled = await loop.run_in_executor(None, mapping.compile)
+            if compiled is not None:
+                mapping.swap(compiled)
+        except Exception:
+            log.exception("Unable to reload mapping file " + str(mapping.path))
+
+
+async def serve_async(portManager, reinitScheduler):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, portManager.reinitialize)
+    runner.start()
+    macros.start()
+    realtime.start()
+    while True:
+        pending = await reinitScheduler.wait_async()
+        if reinitScheduler.take_resyncs():
+            await loop.run_in_executor(None, portManager.resync)
+        if not pending:
+            continue
+        await loop.run_in_executor(None, portManager.reinitialize)
+        reinitScheduler.done()
+
+
+def run_async(args):
+    """
+    Main loop of the asyncio runtime: the handlers, the reinit requests and the port and mapping
+    watchers all run in one event loop. Output ports keep their sender thread
+    """
+    import asyncio
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if args.realtime:
+        # The handlers run in the loop thread, i.e. this one
+        realtime.apply(args.cpu)
+        realtime.enter_thread()
+        metrics.register_provider("realtime", realtime.stats)
+    if args.journal:
+        journal.open(args.journal)
+        metrics.register_provider("journal", journal.stats)
+    mapping = MidiMapping(args.mapping)
+    reinitScheduler = AsyncReinitScheduler(loop)
+    strobotSupervisor = StrobotSupervisor()
+    strobotSupervisor.start()
+    metrics.register_provider("reinit", reinitScheduler.stats)
+    metrics.register_provider("strobot", strobotSupervisor.stats)
+    metrics.register_provider("macros", macros.stats)
+    metrics.register_provider("commands", runner.stats)
+    metrics.register_provider("setlist", mapping.setlist_stats)
+    statsServer = StatsServer(args.stats_socket) if args.stats_socket else None
+
+    portManager = MidiPortManager(mapping, inputWrapper=lambda port, name: AsyncMidiInput(port, name, loop))
+    metrics.register_provider("ports", portManager.stats)
+    metrics.register_provider("network", network_stats)
+    add_routes(portManager, mapping, reinitScheduler, strobotSupervisor)
+    controlServer = None
+    if args.control_socket:
+        # Injected messages are handled in the loop, like the MIDI events
+        controlServer = ControlServer(args.control_socket,
+                                      control_commands(portManager, mapping, reinitScheduler, strobotSupervisor,
+                                                       call=loop.call_soon_threadsafe))
+        metrics.register_provider("control", controlServer.stats)
+
+    tasks = [loop.create_task(watch_ports(portManager))]
+    if mapping.path is not None:
+        tasks.append(loop.create_task(watch_mapping(mapping)))
+    try:
+        log.debug("Attaching available MIDI input callback handlers.")
+        loop.run_until_complete(serve_async(portManager, reinitScheduler))
+    except KeyboardInterrupt:
+        log.debug('Shutting down program')
+    finally:
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        macros.close()
+        runner.close()
+        portManager.close()
+        strobotSupervisor.close()
+        journal.close()
+        realtime.close()
+        if statsServer is not None:
+            statsServer.close()
+        if controlServer is not None:
+            controlServer.close()
+        loop.close()
+
 
 def main(args=None):
     """
     Main program function.
     No argument is to be passed to the program, and no user input is expected
     The program must be autonomous, and is executed at Minimouk's startup
+    The routing rules are read from midi2command.json next to this script if it exists,
+    and the file is reloaded whenever it changes
 
     """
 
-    logging.basicConfig(format="%(name)s: %(levelname)s - %(message)s", level=logging.DEBUG)
-    
-    midiport_emergencyControl_available = False
-    midiport_abletonInVoiceFx_available = False
-    midiport_abletonOut_available = False
-    
-
-    try:
-        midiin_emergencyControl, port_name_emergencyControl = open_midiport(MIDI_BUS_CONFIGURATION_EMERGENCY_CONTROL, type_ = "input", interactive=False)
-        midiport_emergencyControl_available = True
-    except (ValueError):
-        log.info("Emergency Control MIDI port unavailable")
-
-    try:
-        midiin_abletonInVoiceFx, port_name_abletonInVoiceFx = open_midiport(MIDI_BUS_CONFIGURATION_ABLETON_IN_VOICE_FX, type_ = "input", interactive=False)
-        midiport_abletonInVoiceFx_available = True
-    except (ValueError):
-        log.info("Ableton Voice FX MIDI port unavailable")
+    parser = argparse.ArgumentParser(prog="midi2command", description=__doc__)
+    parser.add_argument("-m", "--mapping", default=MAPPING_PATH if os.path.exists(MAPPING_PATH) else None,
+                        help="JSON/YAML mapping file with the routing rules and port names")
+    parser.add_argument("--stats-socket", default=STATS_SOCKET_PATH,
+                        help="UNIX socket publishing the latency and throughput stats, empty to disable")
+    parser.add_argument("--control-socket", default=CONTROL_SOCKET_PATH,
+                        help="UNIX socket of the JSON-lines control API, empty to disable (not in sharded mode)")
+    parser.add_argument("--journal", default=JOURNAL_PATH,
+                        help="Binary journal of the MIDI messages received and sent, empty to disable")
+    parser.add_argument("--sharded", action="store_true",
+                        help="Route each input port in its own worker process (the output state, coalescing and rate limits "
+                             "of a port shared by two routes are then per worker)")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="Run the handlers, timers and port supervision in a single asyncio event loop")
+    parser.add_argument("--realtime", action="store_true",
+                        help="Raise the priority of the MIDI threads where permitted, and control the garbage collections")
+    parser.add_argument("--cpu", type=int,
+                        help="CPU the MIDI threads are pinned to in realtime mode (Linux only)")
+    args = parser.parse_args(args)
+    if args.realtime and args.sharded:
+        parser.error("--realtime cannot be combined with --sharded")
+    if args.cpu is not None and not args.realtime:
+        parser.error("--cpu needs --realtime")
 
-    try:
-        midiout_abletonOut, port_name_abletonOut            = open_midiport(MIDI_BUS_CONFIGURATION_ABLETON_OUT, type_ = "output", interactive=False)
-        midiport_abletonOut_available = True
-    except (ValueError):
-        log.info("MIDI back to Ableton MIDI port unavailable")
-
-    handler_emergencyControl_Strobot = None
-    handler_emergencyControl_MIDI    = None
-    handler_abletonVoiceFx           = None
-
-    # These three callbacks should always be available - if not, the computer is not configured properly
-    log.debug("Attaching available MIDI input callback handlers.")
-    if midiport_emergencyControl_available:
-        handler_emergencyControl_Strobot = MidiInputHandler_emergencyControl_Strobot(midiin_emergencyControl)
-        midiin_emergencyControl.set_callback(handler_emergencyControl_Strobot)
-        log.info(" *** Emergency control (Strobot) callback is attached")
-
-    if midiport_emergencyControl_available:
-        handler_emergencyControl_MIDI = MidiInputHandler_emergencyControl_MIDI(midiin_emergencyControl, midiout_abletonOut)
-        midiin_emergencyControl.set_callback(handler_emergencyControl_MIDI)
-        log.info(" *** Emergency control (MIDI) callback is attached")
-
-    if midiport_abletonInVoiceFx_available and midiport_abletonOut_available:
-        handler_abletonVoiceFx   = MidiInputHandler_abletonVoiceFx(midiin_abletonInVoiceFx, midiout_abletonOut)
-        midiin_abletonInVoiceFx.set_callback(handler_abletonVoiceFx)
-        log.info(" *** Ableton VoiceFX callback is attached")
+    logging.basicConfig(format="%(name)s: %(levelname)s - %(message)s", level=logging.DEBUG)
+    startup.mark("modules imported")
+
+    if args.sharded:
+        return run_sharded(args)
+    if args.asyncio:
+        return run_async(args)
+
+    mapping = MidiMapping(args.mapping)
+    startup.mark("mapping loaded")
+    reinitScheduler = ReinitScheduler()
+    strobotSupervisor = StrobotSupervisor()
+    strobotSupervisor.start()
+    if args.realtime:
+        realtime.apply(args.cpu)
+    portManager = MidiPortManager(mapping, inputWrapper=RealtimeMidiInput if args.realtime else None)
+    add_routes(portManager, mapping, reinitScheduler, strobotSupervisor)
+    statsServer = None
+    controlServer = None
 
     try:
-        # If requested, recreate the MIDI emergency control object
-        global REINIT_CALL
+        log.debug("Attaching available MIDI input callback handlers.")
+        portManager.start()
+        startup.mark("ports opened")
+
+        # Everything else waits until the routes are up
+        mapping.watch()
+        if args.journal:
+            journal.open(args.journal)
+            metrics.register_provider("journal", journal.stats)
+        metrics.register_provider("startup", startup.stats)
+        metrics.register_provider("macros", macros.stats)
+        metrics.register_provider("commands", runner.stats)
+        metrics.register_provider("setlist", mapping.setlist_stats)
+        metrics.register_provider("reinit", reinitScheduler.stats)
+        metrics.register_provider("strobot", strobotSupervisor.stats)
+        metrics.register_provider("ports", portManager.stats)
+        metrics.register_provider("network", network_stats)
+        if args.realtime:
+            metrics.register_provider("realtime", realtime.stats)
+        statsServer = StatsServer(args.stats_socket) if args.stats_socket else None
+        if args.control_socket:
+            controlServer = ControlServer(args.control_socket,
+                                          control_commands(portManager, mapping, reinitScheduler, strobotSupervisor))
+            metrics.register_provider("control", controlServer.stats)
+        runner.start()
+        macros.start()
+        startup.mark("startup done")
+        realtime.start()
+
+        # Ports heal by themselves, the reinit note forces all of them to be reopened at once
         while True:
-
-            if REINIT_CALL:
-
-                if midiport_emergencyControl_available:
-                    handler_emergencyControl_MIDI.close()
-                    handler_emergencyControl_Strobot.close()
-                    handler_abletonVoiceFx.close()
-                    midiout_abletonOut.close_port()
-
-                    try:
-                        midiout_abletonOut, port_name_abletonOut            = open_midiport(MIDI_BUS_CONFIGURATION_ABLETON_OUT, type_ = "output", interactive=False)
-                        midiport_abletonOut_available = True
-                    except (ValueError):
-                        log.info("MIDI back to Ableton MIDI port unavailable")
-
-                    if midiport_emergencyControl_available:
-                        handler_emergencyControl_Strobot = MidiInputHandler_emergencyControl_Strobot(midiin_emergencyControl)
-                        midiin_emergencyControl.set_callback(handler_emergencyControl_Strobot)
-                        log.info(" *** Emergency control (Strobot) callback is attached")
-
-                    if midiport_abletonInVoiceFx_available and midiport_abletonOut_available:
-                        handler_abletonVoiceFx   = MidiInputHandler_abletonVoiceFx(midiin_abletonInVoiceFx, midiout_abletonOut)
-                        midiin_abletonInVoiceFx.set_callback(handler_abletonVoiceFx)
-                        log.info(" *** Ableton VoiceFX callback is attached")
-
-                    if midiport_emergencyControl_available and midiport_abletonOut_available:
-                        handler_emergencyControl_MIDI = MidiInputHandler_emergencyControl_MIDI(midiin_emergencyControl, midiout_abletonOut)
-                        midiin_emergencyControl.set_callback(handler_emergencyControl_MIDI)
-                        log.info(" *** Emergency control (MIDI) callback is attached")
-
-                REINIT_CALL = False
-            time.sleep(1)
+            pending = reinitScheduler.wait()
+            if reinitScheduler.take_resyncs():
+                portManager.resync()
+            if not pending:
+                continue
+            portManager.reinitialize()
+            reinitScheduler.done()
 
 
     except KeyboardInterrupt:
         log.debug('Shutting down program')
     finally:
-        if handler_emergencyControl_MIDI != None:
-            handler_emergencyControl_MIDI.close()        
-        midiin_emergencyControl.close_port()
-        midiin_abletonInVoiceFx.close_port()
-        midiout_abletonOut.close_port()
-        del midiin_emergencyControl
-        del midiin_abletonInVoiceFx
-        del midiout_abletonOut
+        macros.close()
+        runner.close()
+        portManager.close()
+        mapping.close()
+        strobotSupervisor.close()
+        journal.close()
+        realtime.close()
+        if statsServer is not None:
+            statsServer.close()
+        if controlServer is not None:
+            controlServer.close()
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]) or 0)
\ No newline at end of file
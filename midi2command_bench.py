@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+#
+# midi2command_bench.py
+#
+"""
+Replay recorded or synthetic MIDI streams through the midi2command handlers and measure
+the callback time, the end-to-end in->out latency and the maximum throughput of each one.
+
+Runs without any hardware: the handlers write to an in-process fake port, or, with --virtual,
+the events go through rtmidi virtual ports. Results are printed as JSON, and can be compared
+against a previous run with --baseline to catch regressions.
+
+    python midi2command_bench.py run --output bench.json
+    python midi2command_bench.py run --baseline bench.json --tolerance 0.25
+    python midi2command_bench.py record "Livid Guitar Wing" guitar_wing.jsonl
+    python midi2command_bench.py run --handler guitar_wing --stream guitar_wing=guitar_wing.jsonl
+"""
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import threading
+import time
+
+import midi2command
+from midi2command import (MidiInputHandler_abletonGtr, MidiInputHandler_abletonVoiceFx,
+                          MidiInputHandler_emergencyControl_MIDI, MidiInputHandler_emergencyControl_Strobot,
+                          MidiInputHandler_guitarWing, MidiMapping, MidiOutputSender, StrobotSupervisor,
+                          ReinitScheduler, OUTPUT_QUEUE_SIZE, STATUS_CC, STATUS_NOTE_OFF, STATUS_NOTE_ON)
+
+log = logging.getLogger('midi2command_bench')
+
+PERCENTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class FakeOutputPort(object):
+    """In-process output port, timestamping every message it receives"""
+    def __init__(self, onMessage=None):
+        self.count = 0
+        self.onMessage = onMessage
+
+    def send_message(self, message):
+        self.count += 1
+        if self.onMessage is not None:
+            self.onMessage(message)
+
+    def close_port(self):
+        pass
+
+
+class BenchStrobotSupervisor(StrobotSupervisor):
+    """Never kills nor launches anything, only counts the restart requests"""
+    def start(self):
+        pass
+
+
+def build_handlers(portOut, mapping):
+    """Name -> handler factory, for every handler class of midi2command"""
+    return {
+        "guitar_wing"       : lambda: MidiInputHandler_guitarWing(None, portOut, mapping),
+        "voice_fx"          : lambda: MidiInputHandler_abletonVoiceFx(None, portOut, mapping),
+        "gtr"               : lambda: MidiInputHandler_abletonGtr(None, portOut, mapping),
+        "emergency_strobot" : lambda: MidiInputHandler_emergencyControl_Strobot(None, BenchStrobotSupervisor()),
+        "emergency_midi"    : lambda: MidiInputHandler_emergencyControl_MIDI(None, ReinitScheduler(), BenchStrobotSupervisor()),
+    }
+
+HANDLER_NAMES = ("guitar_wing", "voice_fx", "gtr", "emergency_strobot", "emergency_midi")
+
+
+def synthetic_stream(name, count, deltatime=0.002):
+    """Build a stream of (message, deltatime) events shaped like what each handler sees on stage"""
+    events = []
+    i = 0
+    while len(events) < count:
+        if name == "guitar_wing":
+            # Big fader sweeps, with a button press every now and then
+            if i % 50 == 49:
+                button = midi2command.PITCH_WING_BIG_ROUND_BUTTON_1 + (i // 50) % 10
+                events.append(([STATUS_NOTE_ON, button, 127], deltatime))
+                events.append(([STATUS_NOTE_OFF, button, 0], deltatime))
+            else:
+                events.append(([STATUS_CC, midi2command.CC_BIG_FADER, abs(100 - (i * 3) % 200)], deltatime))
+        elif name == "voice_fx":
+            pitch = (i * 7) % 128
+            events.append(([STATUS_NOTE_ON + midi2command.ABLETON_VOICE_FX_CTRL_CHANNEL, pitch, 100], deltatime))
+            events.append(([STATUS_NOTE_OFF + midi2command.ABLETON_VOICE_FX_CTRL_CHANNEL, pitch, 0], deltatime))
+        elif name == "gtr":
+            events.append(([STATUS_NOTE_ON + midi2command.ABLETON_GTR_CTRL_CHANNEL, 1 + i % 12, 100], deltatime))
+        else:
+            # Traffic on the emergency bus which must not trigger anything
+            events.append(([STATUS_NOTE_ON + 6, 60 + i % 12, 100], deltatime))
+            events.append(([STATUS_CC + 6, 7, i % 128], deltatime))
+        i += 1
+    return events[:count]
+
+
+def read_stream(path):
+    """Read a stream recorded by the record command: one JSON [message, deltatime] per line"""
+    events = []
+    with open(path) as streamFile:
+        for line in streamFile:
+            if line.strip():
+                message, deltatime = json.loads(line)
+                events.append((message, deltatime))
+    return events
+
+
+def summarize(values):
+    """Percentiles and max of a list of durations in seconds, in microseconds"""
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    summary = {"count": len(values), "mean_us": sum(values) / len(values) * 1e6, "max_us": values[-1] * 1e6}
+    for q in PERCENTILES:
+        summary["p%g_us" % (q * 100)] = values[int(q * (len(values) - 1))] * 1e6
+    return summary
+
+
+def measure_callback(factory, events):
+    """Time spent in the callback for each event, with the production output sender"""
+    handler = factory()
+    durations = []
+    clock = time.perf_counter
+    for event in events:
+        start = clock()
+        handler(event)
+        durations.append(clock() - start)
+    return summarize(durations)
+
+
+def measure_throughput(name, events, mapping, repeat=20, size=OUTPUT_QUEUE_SIZE):
+    """
+    Events per second routed by the callback, until every resulting message has been sent. Events
+    are only fed while the sender queue is under half full, so that the output port is drained
+    rather than messages dropped: a run which still dropped some is not valid, as its rate counts
+    events whose messages never reached the port
+    """
+    port = FakeOutputPort()
+    sender = MidiOutputSender(port, "bench " + name, size=size, coalesceWindow=0.0)
+    handler = build_handlers(sender, mapping)[name]()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for event in events:
+            while sender.depth() >= size // 2:
+                time.sleep(0)
+            handler(event)
+    while sender.depth():
+        time.sleep(0.0001)
+    elapsed = time.perf_counter() - start
+    sender.close_port()
+    return {"events": len(events) * repeat, "messages_out": port.count, "events_per_s": len(events) * repeat / elapsed,
+            "dropped": sender.droppedCount, "valid": sender.droppedCount == 0}
+
+
+def measure_latency(name, events, mapping, interval):
+    """
+    End-to-end latency between feeding an event and its messages reaching the output port,
+    through the production output sender. Events are paced interval seconds apart, so that each
+    output message can be matched with the last event fed.
+    """
+    state = {"sentAt": 0.0}
+    latencies = []
+    clock = time.perf_counter
+    port = FakeOutputPort(lambda message: latencies.append(clock() - state["sentAt"]))
+    sender = MidiOutputSender(port, "bench " + name)
+    handler = build_handlers(sender, mapping)[name]()
+    for event in events:
+        deadline = clock() + interval
+        state["sentAt"] = clock()
+        handler(event)
+        while clock() < deadline:
+            pass
+    sender.close_port()
+    return summarize(latencies)
+
+
+def measure_virtual_latency(name, events, mapping, interval):
+    """Same as measure_latency, but through rtmidi virtual ports on both sides of the handler"""
+    import rtmidi
+    from rtmidi.midiutil import open_midiport
+
+    state = {"sentAt": 0.0}
+    latencies = []
+    clock = time.perf_counter
+
+    source = rtmidi.MidiOut()
+    source.open_virtual_port("midi2command bench source")
+    sink = rtmidi.MidiOut()
+    sink.open_virtual_port("midi2command bench sink")
+    time.sleep(0.1)
+    handlerIn, _ = open_midiport("midi2command bench source", type_="input", interactive=False)
+    monitor, _ = open_midiport("midi2command bench sink", type_="input", interactive=False)
+    sender = MidiOutputSender(sink, "bench " + name)
+    try:
+        handlerIn.set_callback(build_handlers(sender, mapping)[name]())
+        monitor.set_callback(lambda event, data=None: latencies.append(clock() - state["sentAt"]))
+        for message, deltatime in events:
+            deadline = clock() + interval
+            state["sentAt"] = clock()
+            source.send_message(message)
+            while clock() < deadline:
+                pass
+        time.sleep(0.1)
+    finally:
+        handlerIn.close_port()
+        monitor.close_port()
+        sender.close_port()
+        source.close_port()
+    return summarize(latencies)
+
+
+def run_benchmark(args):
+    logging.getLogger('midi2command').setLevel(logging.WARNING)
+    mapping = MidiMapping(args.mapping)
+    streams = dict(stream.split("=", 1) for stream in args.stream)
+    results = {
+        "python"   : sys.version.split()[0],
+        "platform" : platform.platform(),
+        "virtual"  : args.virtual,
+        "handlers" : {},
+    }
+    for name in args.handler or HANDLER_NAMES:
+        events = read_stream(streams[name]) if name in streams else synthetic_stream(name, args.events)
+        latencyEvents = events[:args.latency_events]
+        log.info("Benchmarking %s with %d events", name, len(events))
+        sender = MidiOutputSender(FakeOutputPort(), "bench " + name)
+        result = {
+            "events"     : len(events),
+            "callback"   : measure_callback(build_handlers(sender, mapping)[name], events),
+            "throughput" : measure_throughput(name, events, mapping),
+        }
+        sender.close_port()
+        if not result["throughput"]["valid"]:
+            log.warning("%s throughput run dropped %d messages", name, result["throughput"]["dropped"])
+        if args.virtual:
+            result["latency"] = measure_virtual_latency(name, latencyEvents, mapping, args.interval)
+        else:
+            result["latency"] = measure_latency(name, latencyEvents, mapping, args.interval)
+        results["handlers"][name] = result
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """List the metrics which got worse than the baseline by more than tolerance (a ratio)"""
+    regressions = []
+    for name, result in results["handlers"].items():
+        reference = baseline.get("handlers", {}).get(name)
+        if reference is None:
+            continue
+        for section in ("callback", "latency"):
+            for metric in ("p50_us", "p99_us"):
+                current, previous = result[section].get(metric), reference.get(section, {}).get(metric)
+                if current is not None and previous and current > previous * (1.0 + tolerance):
+                    regressions.append("%s %s %s: %.1f -> %.1f" % (name, section, metric, previous, current))
+        if not result["throughput"].get("valid", True):
+            regressions.append("%s throughput: %d messages dropped, events_per_s not comparable" % (name, result["throughput"]["dropped"]))
+            continue
+        current, previous = result["throughput"]["events_per_s"], reference.get("throughput", {}).get("events_per_s")
+        if previous and reference["throughput"].get("valid", True) and current < previous * (1.0 - tolerance):
+            regressions.append("%s throughput events_per_s: %.0f -> %.0f" % (name, previous, current))
+    return regressions
+
+
+def record_stream(args):
+    """Record the events of an input port until interrupted, in the format read by --stream"""
+    from rtmidi.midiutil import open_midiport
+
+    midiin, portName = open_midiport(args.port, type_="input", interactive=False)
+    lock = threading.Lock()
+    count = [0]
+    with open(args.file, "w") as streamFile:
+        def callback(event, data=None):
+            message, deltatime = event
+            with lock:
+                streamFile.write(json.dumps([message, deltatime]) + "\n")
+                count[0] += 1
+
+        midiin.set_callback(callback)
+        log.info("Recording %s to %s, press Ctrl-C to stop", portName, args.file)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            midiin.close_port()
+    log.info("Recorded %d events", count[0])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="midi2command_bench", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="action")
+
+    run = subparsers.add_parser("run", help="Run the benchmarks")
+    run.add_argument("--handler", action="append", choices=HANDLER_NAMES,
+                     help="Handler to benchmark, can be repeated (default: all)")
+    run.add_argument("--stream", action="append", default=[], metavar="HANDLER=FILE",
+                     help="Replay a recorded stream for a handler instead of the synthetic one")
+    run.add_argument("--mapping", help="Mapping file to route with (default: the built-in routes)")
+    run.add_argument("--events", type=int, default=20000, help="Number of synthetic events per handler")
+    run.add_argument("--latency-events", type=int, default=2000, help="Number of events used for the latency measure")
+    run.add_argument("--interval", type=float, default=0.001, help="Seconds between two events for the latency measure")
+    run.add_argument("--virtual", action="store_true", help="Measure the latency through rtmidi virtual ports")
+    run.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    run.add_argument("--baseline", help="Previous JSON results to compare with, exit with 1 on regression")
+    run.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative degradation against the baseline")
+
+    record = subparsers.add_parser("record", help="Record the events of an input port to a stream file")
+    record.add_argument("port", help="Input port name (or substring)")
+    record.add_argument("file", help="Stream file to write")
+
+    args = parser.parse_args(args)
+    logging.basicConfig(format="%(name)s: %(levelname)s - %(message)s", level=logging.INFO)
+
+    if args.action == "record":
+        record_stream(args)
+        return 0
+    if args.action != "run":
+        parser.print_help()
+        return 2
+
+    results = run_benchmark(args)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            outputFile.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            regressions = find_regressions(results, json.load(baselineFile), args.tolerance)
+        for regression in regressions:
+            log.error("Regression: " + regression)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]) or 0)
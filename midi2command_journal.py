@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#
+# midi2command_journal.py
+#
+"""
+Read the binary journal written by midi2command: dump the recorded MIDI messages, filtered by
+source, direction, status, channel or time, and measure the latency between the messages
+received on a handler and the messages it sent to an output port. The program changes of a
+recorded show can also be turned into the setlist section of a mapping file, with the latency
+of the preset switches from the input events which triggered them.
+
+A journal path also reads its rotated files (path.4 ... path.1), oldest first.
+
+    python midi2command_journal.py dump /tmp/midi2command.journal --source gtr --status 0xC0
+    python midi2command_journal.py dump /tmp/midi2command.journal --since 120 --until 180 --json
+    python midi2command_journal.py latency /tmp/midi2command.journal --input gtr --output audio_interface_out
+    python midi2command_journal.py setlist /tmp/midi2command.journal --output audio_interface_out --channel 4
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from midi2command import journal_files, read_journal
+from midi2command_bench import summarize
+
+log = logging.getLogger('midi2command_journal')
+
+
+def read_records(paths, rotated=True):
+    """Records of every given journal (and of its rotated files), in file order"""
+    for path in paths:
+        for journalPath in (journal_files(path) if rotated else [path]) or [path]:
+            for record in read_journal(journalPath):
+                yield record
+
+
+def filter_records(records, args):
+    """Apply the dump/latency filters. --since/--until are seconds from the first record"""
+    first = None
+    for record in records:
+        if first is None:
+            first = record["time"]
+        elapsed = record["time"] - first
+        message = record["message"]
+        if args.source and record["source"] not in args.source:
+            continue
+        if args.direction and record["direction"] != args.direction:
+            continue
+        if args.status is not None and message[0] & 0xF0 != args.status & 0xF0:
+            continue
+        # Channels are numbered from 1, as in the mapping file
+        if args.channel is not None and (message[0] >= 0xF0 or message[0] & 0x0F != args.channel - 1):
+            continue
+        if args.since is not None and elapsed < args.since:
+            continue
+        if args.until is not None and elapsed > args.until:
+            continue
+        yield record
+
+
+def format_record(record):
+    wallclock = time.strftime("%H:%M:%S", time.localtime(record["time"])) + ("%.6f" % (record["time"] % 1))[1:]
+    return "%s %+10.6f %-3s %-20s %s" % (wallclock, record["deltatime"], record["direction"], record["source"],
+                                          " ".join("%02X" % byte for byte in record["message"]))
+
+
+def dump(args):
+    count = 0
+    for record in filter_records(read_records(args.journal, not args.no_rotated), args):
+        print(json.dumps(record) if args.json else format_record(record))
+        count += 1
+    log.info("%d record(s)", count)
+
+
+def match_latencies(records, inputSource, outputSource, window):
+    """
+    Pair each message sent to the output with the latest unmatched message received by the input
+    handler at most window seconds before it. Return the latencies and the unmatched input records
+    """
+    pending = []
+    matched = []
+    unmatched = []
+    for record in records:
+        if record["direction"] == "in" and record["source"] == inputSource:
+            pending.append(record)
+        elif record["direction"] == "out" and record["source"] == outputSource:
+            while pending and record["timestamp"] - pending[0]["timestamp"] > window:
+                unmatched.append(pending.pop(0))
+            if pending:
+                matched.append(record["timestamp"] - pending.pop()["timestamp"])
+    unmatched.extend(pending)
+    return matched, unmatched
+
+
+def latency(args):
+    args.source = None
+    args.direction = None
+    records = filter_records(read_records(args.journal, not args.no_rotated), args)
+    matched, unmatched = match_latencies(records, args.input, args.output, args.window)
+    summary = summarize(matched)
+    summary["unmatched_inputs"] = len(unmatched)
+    print(json.dumps(summary, indent=2, sort_keys=True))
+    if args.show_unmatched:
+        for record in unmatched:
+            print(format_record(record))
+
+
+def extract_setlist(records, outputSource, channel):
+    """Programs sent to an output port on a channel (1-16), in order, without the repeats"""
+    presets = []
+    for record in records:
+        message = record["message"]
+        if record["direction"] == "out" and record["source"] == outputSource and len(message) == 2 \
+                and message[0] == 0xC0 + channel - 1 and (not presets or presets[-1] != message[1]):
+            presets.append(message[1])
+    return presets
+
+
+def switch_latencies(records, inputSource, outputSource, channel, window):
+    """
+    Latency of each preset switch (a program change to a new program, sent to an output port on a
+    channel), from the last message received by the input handler at most window seconds before it
+    """
+    latencies = []
+    lastInput = None
+    program = None
+    for record in records:
+        message = record["message"]
+        if record["direction"] == "in" and record["source"] == inputSource:
+            lastInput = record
+        elif record["direction"] == "out" and record["source"] == outputSource and len(message) == 2 and message[0] == 0xC0 + channel - 1 \
+                and message[1] != program:
+            program = message[1]
+            if lastInput is not None and record["timestamp"] - lastInput["timestamp"] <= window:
+                latencies.append(record["timestamp"] - lastInput["timestamp"])
+    return latencies
+
+
+def setlist(args):
+    args.source = None
+    args.direction = None
+    args.status = None
+    # The triggering input events may be on any channel
+    channel, args.channel = args.channel, None
+    records = list(filter_records(read_records(args.journal, not args.no_rotated), args))
+    presets = extract_setlist(records, args.output, channel)
+    print(json.dumps({"outputs": {args.output: {"setlist": {"channel": channel, "presets": presets}}}}, indent=2))
+    latencies = switch_latencies(records, args.input, args.output, channel, args.window)
+    log.info("Switch latency from the triggering input event: %s", json.dumps(summarize(latencies), sort_keys=True))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="midi2command_journal", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="action")
+
+    def add_filters(subparser):
+        subparser.add_argument("journal", nargs="+", help="Journal file(s)")
+        subparser.add_argument("--no-rotated", action="store_true", help="Do not read the rotated files of the journal")
+        subparser.add_argument("--status", type=lambda value: int(value, 0), help="Status byte, e.g. 0xB0 for CC, any channel")
+        subparser.add_argument("--channel", type=int, help="MIDI channel (1-16)")
+        subparser.add_argument("--since", type=float, help="Skip the records before this many seconds into the journal")
+        subparser.add_argument("--until", type=float, help="Skip the records after this many seconds into the journal")
+
+    dumpParser = subparsers.add_parser("dump", help="Print the records, optionally filtered")
+    add_filters(dumpParser)
+    dumpParser.add_argument("--source", action="append", help="Handler or output port, can be repeated")
+    dumpParser.add_argument("--direction", choices=("in", "out"))
+    dumpParser.add_argument("--json", action="store_true", help="One JSON record per line")
+
+    latencyParser = subparsers.add_parser("latency", help="Latency between the messages of a handler and of an output port")
+    add_filters(latencyParser)
+    latencyParser.add_argument("--input", required=True, help="Handler receiving the messages, e.g. gtr")
+    latencyParser.add_argument("--output", required=True, help="Output port sending the result, e.g. audio_interface_out")
+    latencyParser.add_argument("--window", type=float, default=0.1, help="Longest latency to consider, in seconds")
+    latencyParser.add_argument("--show-unmatched", action="store_true", help="Print the input messages without any output")
+
+    setlistParser = subparsers.add_parser("setlist", help="Setlist of the program changes sent, for the mapping file")
+    add_filters(setlistParser)
+    setlistParser.add_argument("--input", default="gtr", help="Handler receiving the events which switch the presets")
+    setlistParser.add_argument("--output", default="audio_interface_out", help="Output port of the program changes")
+    setlistParser.add_argument("--window", type=float, default=0.1, help="Longest switch latency to consider, in seconds")
+
+    args = parser.parse_args(args)
+    logging.basicConfig(format="%(name)s: %(levelname)s - %(message)s", level=logging.INFO)
+
+    if args.action == "dump":
+        dump(args)
+    elif args.action == "latency":
+        latency(args)
+    elif args.action == "setlist":
+        if args.channel is None:
+            parser.error("setlist needs the --channel of the program changes")
+        setlist(args)
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]) or 0)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# test_midi2command_mapping.py
+#
+"""
+Routing tables compiled from DEFAULT_MAPPING, against the messages the hard-coded handlers sent
+before the mapping file existed.
+
+    python -m unittest test_midi2command_mapping
+"""
+
+import unittest
+
+from midi2command import (ABLETON_GTR_CTRL_CHANNEL, ABLETON_VOICE_FX_CTRL_CHANNEL, CC_BIG_FADER,
+                          OUTPUT_CHANNEL_ABLETON_VOICEFX, OUTPUT_CHANNEL_KEMPER_AMP, STATUS_CC,
+                          STATUS_NOTE_OFF, STATUS_NOTE_ON, STATUS_PC, MidiMapping)
+
+
+class DefaultMappingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tables = MidiMapping(None).tables
+
+    def lookup(self, table, event):
+        return [list(message) for message in self.tables[table].lookup(event)]
+
+    def test_guitar_wing_buttons(self):
+        expected = {
+            (STATUS_NOTE_ON, 36)  : [[STATUS_CC + 4, 13, 127]],
+            (STATUS_NOTE_ON, 37)  : [[STATUS_CC, 16, 127], [STATUS_NOTE_ON, 44, 127]],
+            (STATUS_NOTE_ON, 38)  : [[STATUS_CC, 16, 110], [STATUS_NOTE_ON, 44, 127]],
+            (STATUS_NOTE_ON, 39)  : [[STATUS_CC, 52, 76]],
+            (STATUS_NOTE_ON, 42)  : [[STATUS_CC, 16, 0]],
+            (STATUS_NOTE_ON, 43)  : [[STATUS_CC, 16, 45]],
+            (STATUS_NOTE_ON, 44)  : [[STATUS_CC, 16, 64]],
+            (STATUS_NOTE_ON, 45)  : [[STATUS_CC, 16, 110]],
+            (STATUS_NOTE_OFF, 36) : [[STATUS_CC + 4, 13, 0]],
+            (STATUS_NOTE_OFF, 37) : [[STATUS_NOTE_ON, 44, 127]],
+            (STATUS_NOTE_OFF, 38) : [[STATUS_NOTE_ON, 44, 127]],
+            (STATUS_NOTE_OFF, 39) : [[STATUS_CC, 52, 0]],
+        }
+        for status in (STATUS_NOTE_ON, STATUS_NOTE_OFF):
+            # Arrows, small switches, toggle and the small rectangles released send nothing
+            for pitch in range(128):
+                self.assertEqual(self.lookup("guitar_wing", [status, pitch, 127]), expected.get((status, pitch), []),
+                                 "status 0x%X, pitch %d" % (status, pitch))
+
+    def test_big_fader(self):
+        for value, sent in ((0, 0), (50, 63), (79, 100), (100, 127)):
+            self.assertEqual(self.lookup("guitar_wing", [STATUS_CC, CC_BIG_FADER, value]), [[STATUS_CC, 56, sent]])
+        self.assertEqual(self.lookup("guitar_wing", [STATUS_CC, CC_BIG_FADER - 1, 100]), [])
+
+    def test_voice_fx(self):
+        noteOn = STATUS_NOTE_ON + ABLETON_VOICE_FX_CTRL_CHANNEL
+        noteOff = STATUS_NOTE_OFF + ABLETON_VOICE_FX_CTRL_CHANNEL
+        voiceFx = STATUS_CC + OUTPUT_CHANNEL_ABLETON_VOICEFX
+        # Pitch 35 disables the RMX Spiral instead
+        self.assertEqual(self.lookup("voice_fx", [noteOn, 35, 100]), [[STATUS_CC, 20, 0]])
+        self.assertEqual(self.lookup("voice_fx", [noteOn, 36, 100]), [[voiceFx, 36, 100]])
+        self.assertEqual(self.lookup("voice_fx", [noteOn, 127, 1]), [[voiceFx, 127, 1]])
+        self.assertEqual(self.lookup("voice_fx", [noteOff, 35, 0]), [[voiceFx, 35, 0]])
+        self.assertEqual(self.lookup("voice_fx", [noteOff, 60, 64]), [[voiceFx, 60, 0]])
+        self.assertEqual(self.lookup("voice_fx", [noteOn + 1, 36, 100]), [])
+        self.assertEqual(self.lookup("voice_fx", [STATUS_CC + ABLETON_VOICE_FX_CTRL_CHANNEL, 36, 100]), [])
+
+    def test_gtr_program_change(self):
+        noteOn = STATUS_NOTE_ON + ABLETON_GTR_CTRL_CHANNEL
+        programChange = STATUS_PC + OUTPUT_CHANNEL_KEMPER_AMP
+        self.assertEqual(self.lookup("gtr", [noteOn, 0, 100]), [[programChange, 0]])
+        self.assertEqual(self.lookup("gtr", [noteOn, 1, 100]), [[programChange, 0]])
+        self.assertEqual(self.lookup("gtr", [noteOn, 5, 100]), [[programChange, 4]])
+        self.assertEqual(self.lookup("gtr", [noteOn, 127, 100]), [[programChange, 126]])
+        self.assertEqual(self.lookup("gtr", [noteOn - 1, 5, 100]), [])
+        self.assertEqual(self.lookup("gtr", [STATUS_NOTE_OFF + ABLETON_GTR_CTRL_CHANNEL, 5, 0]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# test_midi2command_network.py
+#
+"""
+Loopback tests of the network ports: a NetworkMidiOut and a NetworkMidiIn on 127.0.0.1, and
+crafted datagrams for the losses, reordering and duplicates.
+
+    python -m unittest test_midi2command_network
+"""
+
+import socket
+import threading
+import time
+import unittest
+
+from midi2command import (NETWORK_HEADER, NETWORK_MAGIC, NETWORK_MESSAGE, NETWORK_MAX_MESSAGE,
+                          NetworkMidiIn, NetworkMidiOut)
+
+
+def datagram(session, sequence, sentAt, messages):
+    """Datagram of a NetworkMidiOut, from (seconds after sentAt, message) pairs"""
+    body = b"".join(NETWORK_MESSAGE.pack(delay, len(message)) + bytes(message) for delay, message in messages)
+    return NETWORK_HEADER.pack(NETWORK_MAGIC, session, sequence, sentAt, len(messages)) + body
+
+
+class Received(object):
+    """Callback of the input port, keeping the messages with their deltatime and arrival time"""
+    def __init__(self):
+        self.events = []
+        self.condition = threading.Condition()
+
+    def __call__(self, event, data=None):
+        with self.condition:
+            self.events.append((event[0], event[1], time.perf_counter()))
+            self.condition.notify_all()
+
+    def wait(self, count, timeout=2.0):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.events) >= count, timeout)
+            return [message for message, _, _ in self.events]
+
+
+class NetworkLoopbackTest(unittest.TestCase):
+    def setUp(self):
+        self.portIn = NetworkMidiIn("udp://127.0.0.1:0", jitterBuffer=0.02)
+        self.address = self.portIn._socket.getsockname()
+        self.name = "udp://127.0.0.1:%d" % self.address[1]
+        self.received = Received()
+        self.portIn.set_callback(self.received)
+        self.raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.raw.close()
+        self.portIn.close_port()
+
+    def send(self, *args):
+        self.raw.sendto(datagram(*args), self.address)
+
+    def test_send_receive(self):
+        portOut = NetworkMidiOut(self.name)
+        messages = [[0x90, 36, 100], [0xB0, 56, 64], [0xC3, 5]]
+        for message in messages:
+            portOut.send_message(message)
+        portOut.flush()
+        self.assertEqual(self.received.wait(3), messages)
+        self.assertEqual(portOut.stats()["datagrams"], 1)
+        stats = self.portIn.stats()
+        self.assertEqual((stats["datagrams"], stats["messages"], stats["lost"], stats["invalid"]), (1, 3, 0, 0))
+        portOut.close_port()
+
+    def test_long_sysex(self):
+        portOut = NetworkMidiOut(self.name)
+        sysex = [0xF0, 0x7D] + [index % 128 for index in range(400)] + [0xF7]
+        portOut.send_message(sysex)
+        portOut.send_message([0x90, 36, 100])
+        portOut.flush()
+        self.assertEqual(self.received.wait(2), [sysex, [0x90, 36, 100]])
+        portOut.send_message([0xF0] + [0] * NETWORK_MAX_MESSAGE + [0xF7])
+        self.assertEqual(portOut.stats()["oversized"], 1)
+        portOut.close_port()
+
+    def test_loss_reordering_and_duplicates(self):
+        now = time.perf_counter()
+        self.send(1, 10, now, [(0.0, [0x90, 36, 1])])
+        self.send(1, 12, now, [(0.0, [0x90, 36, 3])])
+        self.assertEqual(self.received.wait(2), [[0x90, 36, 1], [0x90, 36, 3]])
+        self.assertEqual(self.portIn.stats()["lost"], 1)
+        self.send(1, 11, now, [(0.0, [0x90, 36, 2])])
+        self.send(1, 11, now, [(0.0, [0x90, 36, 2])])
+        self.send(1, 12, now, [(0.0, [0x90, 36, 3])])
+        self.send(1, 13, now, [(0.0, [0x90, 36, 4])])
+        self.assertEqual(self.received.wait(4)[2:], [[0x90, 36, 2], [0x90, 36, 4]])
+        stats = self.portIn.stats()
+        self.assertEqual((stats["lost"], stats["reordered"], stats["duplicates"], stats["datagrams"]), (0, 1, 2, 4))
+
+    def test_sessions(self):
+        # Two senders (e.g. the workers of a sharded instance) with their own sequence numbers
+        now = time.perf_counter()
+        self.send(1, 0, now, [(0.0, [0x90, 36, 1])])
+        self.send(2, 500, now, [(0.0, [0x90, 37, 1])])
+        self.send(1, 1, now, [(0.0, [0x90, 36, 2])])
+        self.send(2, 501, now, [(0.0, [0x90, 37, 2])])
+        self.assertEqual(len(self.received.wait(4)), 4)
+        stats = self.portIn.stats()
+        self.assertEqual((stats["lost"], stats["reordered"], stats["duplicates"]), (0, 0, 0))
+
+    def test_timing(self):
+        # The messages of a datagram are played out with their spacing on the sender
+        now = time.perf_counter()
+        self.send(1, 0, now, [(0.0, [0x90, 36, 1]), (0.02, [0x90, 36, 2]), (0.05, [0x90, 36, 3])])
+        self.received.wait(3)
+        times = [at for _, _, at in self.received.events]
+        deltatimes = [deltatime for _, deltatime, _ in self.received.events]
+        self.assertAlmostEqual(times[1] - times[0], 0.02, delta=0.01)
+        self.assertAlmostEqual(times[2] - times[0], 0.05, delta=0.01)
+        self.assertEqual(deltatimes[0], 0.0)
+        self.assertAlmostEqual(deltatimes[1], 0.02, places=4)
+        self.assertAlmostEqual(deltatimes[2], 0.03, places=4)
+        self.assertEqual(self.portIn.stats()["late"], 0)
+
+    def test_invalid(self):
+        self.raw.sendto(b"not a datagram", self.address)
+        now = time.perf_counter()
+        self.send(1, 0, now, [(0.0, [0x90, 200, 1]), (0.0, [0x90, 36, 1])])
+        self.assertEqual(self.received.wait(1), [[0x90, 36, 1]])
+        self.assertEqual(self.portIn.stats()["invalid"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()